@@ -0,0 +1,395 @@
+import atexit
+import logging
+import threading
+import time
+from datetime import date, timedelta, timezone
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Attendance times are evaluated in Phnom Penh time (UTC+7, no DST)
+PHNOM_PENH_TZ = timezone(timedelta(hours=7))
+# Grace period after the shift start when a student has none configured
+DEFAULT_GRACE_MINUTES = 15
+
+attendance_commit_seconds = Histogram(
+    'attendance_commit_seconds', 'Duration of attendance batch commits to Firestore.', ['outcome'])
+
+
+def parse_grace_minutes(student_data):
+    """
+    Returns the student's grace period in minutes, or the default. Accepts
+    numbers and numeric strings like "30".
+    """
+    # Check for both 'gracePeriodMinutes' and a common typo 'gradePeriodMinutes'
+    student_grace_period = student_data.get("gracePeriodMinutes") or student_data.get("gradePeriodMinutes")
+    if student_grace_period is None:
+        return DEFAULT_GRACE_MINUTES
+    try:
+        # This handles both numbers (int, float) and strings like "30"
+        return int(float(student_grace_period))
+    except (ValueError, TypeError):
+        logger.warning("Could not parse grace period %r. Using default.", student_grace_period)
+        return DEFAULT_GRACE_MINUTES
+
+
+class ShiftSchedule:
+    """Precomputed start time and default on-time deadline of one shift."""
+
+    __slots__ = ('start_time', 'start_minutes', 'default_deadline_minutes')
+
+    def __init__(self, start_time, start_minutes):
+        self.start_time = start_time
+        self.start_minutes = start_minutes
+        self.default_deadline_minutes = start_minutes + DEFAULT_GRACE_MINUTES
+
+    def deadline_minutes(self, grace_minutes):
+        """On-time deadline in minutes after midnight, Phnom Penh time."""
+        if grace_minutes == DEFAULT_GRACE_MINUTES:
+            return self.default_deadline_minutes
+        return self.start_minutes + grace_minutes
+
+
+def build_shift_schedules(class_docs):
+    """
+    Turns (class_id, class_data) pairs into {class_id: {shift: ShiftSchedule}}.
+    Shifts without a parseable "HH:MM" startTime are left out.
+    """
+    schedules = {}
+    for class_id, class_data in class_docs:
+        shifts = {}
+        for shift_name, shift_config in ((class_data or {}).get("shifts") or {}).items():
+            start_time = shift_config.get("startTime") if isinstance(shift_config, dict) else None
+            if not start_time:
+                continue
+            try:
+                start_hour, start_minute = map(int, start_time.split(':'))
+            except (ValueError, AttributeError):
+                logger.warning("Ignoring unparseable startTime %r for class %s, shift %s.", start_time, class_id, shift_name)
+                continue
+            shifts[shift_name] = ShiftSchedule(start_time, start_hour * 60 + start_minute)
+        schedules[class_id] = shifts
+    return schedules
+
+
+class ClassScheduleCache:
+    """
+    Cache of class/shift start times used for the late/present decision.
+
+    Schedules are loaded once and kept current by a Firestore snapshot
+    listener on the `classes` collection, which replaces them whenever a
+    class changes; a quiet listener means nothing changed, so it never
+    triggers a reload. Only if the client cannot listen do the schedules
+    expire after `ttl` seconds: the next lookup then triggers a reload on a
+    background thread and keeps answering from the previous schedules, so
+    the request path never reads Firestore after the first load.
+    """
+
+    def __init__(self, db, ttl=600):
+        self.db = db
+        self.ttl = ttl
+        self.schedules = None
+        self.loaded_at = 0
+        self.listening = False
+        self._reloading = False
+        self._lock = threading.Lock()
+        self._watch = None
+
+    def _set_schedules(self, class_docs):
+        self.schedules = build_shift_schedules(class_docs)
+        self.loaded_at = time.time()
+
+    def reload(self):
+        """Streams the classes collection and replaces the schedules."""
+        try:
+            started = time.perf_counter()
+            self._set_schedules((class_doc.id, class_doc.to_dict()) for class_doc in self.db.collection("classes").stream())
+            logger.info("Loaded shift schedules for %d classes in %.2fs", len(self.schedules), time.perf_counter() - started)
+        except Exception:
+            logger.exception("Could not load class configurations")
+        finally:
+            self._reloading = False
+
+    def _on_snapshot(self, class_snapshots, changes, read_time):
+        """Listener callback: every snapshot holds the full classes collection."""
+        try:
+            self._set_schedules((class_doc.id, class_doc.to_dict()) for class_doc in class_snapshots)
+            logger.info("Shift schedules updated from listener (%d classes).", len(self.schedules))
+        except Exception:
+            logger.exception("Could not apply class configuration changes")
+
+    def start(self):
+        """Subscribes the change listener, or loads once if listeners are unsupported."""
+        if not self.db:
+            return
+        try:
+            self._watch = self.db.collection("classes").on_snapshot(self._on_snapshot)
+            self.listening = True
+        except Exception as e:
+            logger.warning("Classes listener unavailable, relying on TTL reloads: %s", e)
+            threading.Thread(target=self.reload, name='class-schedules', daemon=True).start()
+
+    def _ensure_loaded(self):
+        if self.schedules is None:
+            # Nothing to serve yet (first scan raced the initial load)
+            with self._lock:
+                if self.schedules is None:
+                    self._reloading = True
+                    self.reload()
+            return
+        if self.listening:
+            return
+        if time.time() - self.loaded_at > self.ttl and not self._reloading:
+            with self._lock:
+                if self._reloading:
+                    return
+                self._reloading = True
+            threading.Thread(target=self.reload, name='class-schedules', daemon=True).start()
+
+    def shift_schedule(self, student_class, student_shift):
+        """Returns the ShiftSchedule of a student's class/shift, or None."""
+        self._ensure_loaded()
+        if not student_class or not student_shift or not self.schedules:
+            return None
+        return self.schedules.get(student_class.replace("Class ", ""), {}).get(student_shift)
+
+    def attendance_status(self, student_data, now_phnom_penh):
+        """
+        Decides 'present' or 'late' for a first scan at `now_phnom_penh`.
+        Students without a known shift start time are counted as present.
+        """
+        student_class = student_data.get("class")
+        student_shift = student_data.get("shift")
+        if not student_class or not student_shift:
+            logger.debug("Student is missing class or shift information.")
+            return "present"
+
+        schedule = self.shift_schedule(student_class, student_shift)
+        if schedule is None:
+            logger.debug("Cannot calculate late status - no start time for class %r, shift %r", student_class, student_shift)
+            return "present"
+
+        grace_minutes = parse_grace_minutes(student_data)
+        deadline_minutes = schedule.deadline_minutes(grace_minutes)
+        now_seconds = now_phnom_penh.hour * 3600 + now_phnom_penh.minute * 60 + now_phnom_penh.second + now_phnom_penh.microsecond / 1e6
+        status = "late" if now_seconds > deadline_minutes * 60 else "present"
+        logger.debug("Attendance calculation: now %s, shift start %s, grace %d min, deadline %02d:%02d -> %s",
+                     now_phnom_penh.strftime('%H:%M:%S'), schedule.start_time, grace_minutes,
+                     deadline_minutes // 60, deadline_minutes % 60, status)
+        return status
+
+
+class AttendanceLedger:
+    """
+    In-memory ledger of today's attendance: who is already marked and with
+    which status, with new records written behind to Firestore.
+
+    The ledger follows the day's `attendance` records through a snapshot
+    listener (or a single query per day if listeners are unsupported), so
+    records made by other instances or by hand are picked up too. New
+    records get their document id up front and are committed by a writer
+    thread in Firestore batches; a failed batch is retried with the same
+    ids, so a retry can never duplicate a record. A batch that still fails
+    goes back to the front of the queue for the next flush, so a Firestore
+    outage delays records instead of losing them. `flush()` drains the
+    queue and runs at interpreter exit; only records that cannot be written
+    even then are dropped (and counted in `failed`).
+    """
+
+    # Firestore rejects batches with more than 500 writes
+    MAX_BATCH_SIZE = 500
+
+    def __init__(self, db, flush_interval=1.0, batch_size=200, max_retries=5, seed_timeout=5.0):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.batch_size = min(batch_size, self.MAX_BATCH_SIZE)
+        self.max_retries = max_retries
+        self.seed_timeout = seed_timeout
+        self.day = None
+        self.listening = False
+        self.written = 0
+        self.failed = 0
+        self._seeded = threading.Event()
+        self._recorded = {}  # authUid -> status, from Firestore
+        self._local = {}     # authUid -> (doc_id, status), marked here and not yet seen in Firestore
+        self._pending = []   # (DocumentReference, record) waiting to be committed
+        self._lock = threading.Lock()
+        self._queued = threading.Condition(self._lock)
+        self._seed_lock = threading.Lock()
+        self._listening_day = None
+        self._watch = None
+        self._thread = None
+
+    @staticmethod
+    def today():
+        return date.today().isoformat()
+
+    def _day_query(self, day):
+        return self.db.collection("attendance").where("date", "==", day)
+
+    def _apply_records(self, day, attendance_docs):
+        recorded = {}
+        doc_ids = set()
+        for attendance_doc in attendance_docs:
+            data = attendance_doc.to_dict() or {}
+            doc_ids.add(attendance_doc.id)
+            auth_uid = data.get("authUid")
+            if auth_uid and auth_uid not in recorded:
+                recorded[auth_uid] = data.get("status", "present")
+        with self._lock:
+            if day != self.day:
+                return
+            self._recorded = recorded
+            # Records made here are authoritative in Firestore once they show up
+            self._local = {uid: mark for uid, mark in self._local.items() if mark[0] not in doc_ids}
+        self._seeded.set()
+
+    def _on_snapshot(self, attendance_snapshots, changes, read_time):
+        """Listener callback: every snapshot holds all of the day's records."""
+        try:
+            self._apply_records(self._listening_day, attendance_snapshots)
+        except Exception:
+            logger.exception("Could not apply attendance changes")
+
+    def _seed(self, day):
+        """Starts following `day`'s records, replacing the previous day's ledger."""
+        with self._lock:
+            self.day = day
+            self._recorded = {}
+            self._local = {}
+            self._seeded.clear()
+        if self._watch is not None:
+            try:
+                self._watch.unsubscribe()
+            except Exception:
+                pass
+            self._watch = None
+
+        self._listening_day = day
+        try:
+            self._watch = self._day_query(day).on_snapshot(self._on_snapshot)
+            self.listening = True
+            return
+        except Exception as e:
+            logger.warning("Attendance listener unavailable, seeding the ledger once per day: %s", e)
+            self.listening = False
+        try:
+            started = time.perf_counter()
+            self._apply_records(day, self._day_query(day).stream())
+            logger.info("Seeded attendance ledger for %s with %d students in %.2fs", day, len(self._recorded), time.perf_counter() - started)
+        except Exception:
+            logger.exception("Could not seed attendance ledger for %s", day)
+
+    def _current_day(self):
+        day = self.today()
+        if day != self.day:
+            with self._seed_lock:
+                if day != self.day:
+                    self._seed(day)
+        return day
+
+    def status(self, auth_uid):
+        """
+        Returns the student's attendance status for today, or None if they
+        are not marked yet. Falls back to a direct query only while the
+        day's ledger could not be seeded.
+        """
+        day = self._current_day()
+        if not self._seeded.wait(self.seed_timeout):
+            logger.warning("Attendance ledger for %s not seeded yet, querying Firestore directly.", day)
+            existing = list(self._day_query(day).where("authUid", "==", auth_uid).limit(1).stream())
+            if existing:
+                return existing[0].to_dict().get("status", "present")
+        with self._lock:
+            if auth_uid in self._local:
+                return self._local[auth_uid][1]
+            return self._recorded.get(auth_uid)
+
+    def mark(self, auth_uid, record):
+        """
+        Queues `record` as the student's attendance for today unless they
+        were marked in the meantime. Returns the status that applies.
+        """
+        with self._lock:
+            if auth_uid in self._local:
+                return self._local[auth_uid][1]
+            if auth_uid in self._recorded:
+                return self._recorded[auth_uid]
+            attendance_ref = self.db.collection("attendance").document()
+            self._local[auth_uid] = (attendance_ref.id, record["status"])
+            self._pending.append((attendance_ref, record))
+            if len(self._pending) >= self.batch_size:
+                self._queued.notify()
+        return record["status"]
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def _commit(self, writes):
+        for attempt in range(1, self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                batch = self.db.batch()
+                for attendance_ref, record in writes:
+                    batch.set(attendance_ref, record)
+                batch.commit()
+                attendance_commit_seconds.observe(time.perf_counter() - started, outcome='ok')
+                self.written += len(writes)
+                logger.debug("Committed %d attendance records.", len(writes))
+                return True
+            except Exception as e:
+                attendance_commit_seconds.observe(time.perf_counter() - started, outcome='error')
+                logger.warning("Attendance batch of %d failed (attempt %d/%d): %s", len(writes), attempt, self.max_retries, e)
+                if attempt < self.max_retries:
+                    time.sleep(min(0.5 * 2 ** (attempt - 1), 8))
+        logger.error("Attendance batch of %d failed %d times; keeping it queued for the next flush.", len(writes), self.max_retries)
+        return False
+
+    def flush(self):
+        """
+        Commits every queued record. Safe to call from any thread. A batch
+        that fails every retry is put back at the front of the queue and the
+        flush stops there. Returns True if the queue was drained.
+        """
+        while True:
+            with self._lock:
+                writes = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+            if not writes:
+                return True
+            if not self._commit(writes):
+                with self._lock:
+                    self._pending[:0] = writes
+                return False
+
+    def _flush_at_exit(self):
+        if self.flush():
+            return
+        with self._lock:
+            writes, self._pending = self._pending, []
+        self.failed += len(writes)
+        for attendance_ref, record in writes:
+            logger.error("Dropped attendance record %s", attendance_ref.id, extra={'fields': {'record': record}})
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if len(self._pending) < self.batch_size:
+                    self._queued.wait(self.flush_interval)
+            try:
+                self.flush()
+                # Roll the ledger over at midnight before the first scan needs it
+                self._current_day()
+            except Exception:
+                logger.exception("Error in attendance writer")
+
+    def start(self):
+        """Seeds today's ledger and starts the writer thread."""
+        if not self.db or self._thread is not None:
+            return
+        self._current_day()
+        self._thread = threading.Thread(target=self._run, name='attendance-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self._flush_at_exit)
@@ -0,0 +1,218 @@
+"""
+In-memory stand-ins for the Firebase services main.py talks to, so the
+recognition pipeline can be benchmarked offline.
+
+FakeFirestore implements the subset of the Firestore client the service
+uses (collections, where/limit queries, stream/get, documents, batches).
+It deliberately has no `on_snapshot`, so the caches fall back to their
+polling/one-off loads exactly as with any client without listeners.
+Every round-trip can be given an artificial latency to make accidental
+Firestore calls on the request path visible in the numbers.
+
+Student embeddings are kept in one float32 matrix and only expanded into
+the Python lists a real client returns when a document is read, so a
+500k-student roster fits in memory.
+"""
+import itertools
+import time
+
+_auto_ids = itertools.count()
+
+
+class EmbeddingRows:
+    """Lazy 'facialEmbeddings' value: rows [start, stop) of a shared matrix."""
+
+    __slots__ = ('matrix', 'start', 'stop')
+
+    def __init__(self, matrix, start, stop):
+        self.matrix = matrix
+        self.start = start
+        self.stop = stop
+
+    def expand(self):
+        return [{'embedding': row.tolist()} for row in self.matrix[self.start:self.stop]]
+
+
+def _materialize(data):
+    return {
+        field: value.expand() if isinstance(value, EmbeddingRows) else value
+        for field, value in data.items()
+    }
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return _materialize(self._data) if self._data is not None else None
+
+
+class FakeDocumentReference:
+    def __init__(self, collection, doc_id):
+        self.collection = collection
+        self.id = doc_id
+
+    def get(self):
+        self.collection.db.round_trip()
+        return FakeDocumentSnapshot(self.id, self.collection.docs.get(self.id))
+
+    def set(self, data, merge=False):
+        self.collection.db.round_trip()
+        self.collection.db.writes += 1
+        if merge and self.id in self.collection.docs:
+            self.collection.docs[self.id].update(data)
+        else:
+            self.collection.docs[self.id] = dict(data)
+
+
+class FakeQuery:
+    def __init__(self, collection, filters=(), limit=None):
+        self.collection = collection
+        self.filters = tuple(filters)
+        self._limit = limit
+
+    def where(self, field, op, value):
+        return FakeQuery(self.collection, self.filters + ((field, op, value),), self._limit)
+
+    def limit(self, count):
+        return FakeQuery(self.collection, self.filters, count)
+
+    def _matches(self, data):
+        for field, op, value in self.filters:
+            if field not in data:
+                return False
+            actual = data[field]
+            if op == '==' and not actual == value:
+                return False
+            if op == '!=' and not actual != value:
+                return False
+            if op == '>' and not actual > value:
+                return False
+            if op == '>=' and not actual >= value:
+                return False
+            if op == '<' and not actual < value:
+                return False
+        return True
+
+    def stream(self):
+        self.collection.db.round_trip()
+        self.collection.db.reads += 1
+        matched = 0
+        for doc_id, data in list(self.collection.docs.items()):
+            if self._limit is not None and matched >= self._limit:
+                return
+            if self._matches(data):
+                matched += 1
+                yield FakeDocumentSnapshot(doc_id, data)
+
+    def get(self):
+        return list(self.stream())
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name):
+        super().__init__(self)
+        self.db = db
+        self.name = name
+        self.docs = {}
+
+    def document(self, doc_id=None):
+        return FakeDocumentReference(self, doc_id or f"auto-{next(_auto_ids)}")
+
+    def add(self, data):
+        reference = self.document()
+        reference.set(data)
+        return None, reference
+
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self.db = db
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append((reference, data, merge))
+
+    def commit(self):
+        self.db.round_trip()
+        for reference, data, merge in self._writes:
+            collection = reference.collection
+            if merge and reference.id in collection.docs:
+                collection.docs[reference.id].update(data)
+            else:
+                collection.docs[reference.id] = dict(data)
+            self.db.writes += 1
+
+
+class FakeFirestore:
+    """Firestore client stand-in with read/write counters and optional latency."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.collections = {}
+        self.reads = 0
+        self.writes = 0
+        self.round_trips = 0
+
+    def round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def collection(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(self, name)
+        return self.collections[name]
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def add_students(self, matrix, row_offsets, uids, profiles):
+        """
+        Adds one student document per entry: rows [row_offsets[i],
+        row_offsets[i + 1]) of `matrix` become its facialEmbeddings.
+        """
+        students = self.collection('students').docs
+        for i, (auth_uid, profile) in enumerate(zip(uids, profiles)):
+            data = dict(profile)
+            data['authUid'] = auth_uid
+            data['facialEmbeddings'] = EmbeddingRows(matrix, row_offsets[i], row_offsets[i + 1])
+            students[f"student-doc-{i:07d}"] = data
+
+
+class FakeAuth:
+    """`firebase_admin.auth.verify_id_token` stand-in with a fixed verification cost."""
+
+    def __init__(self, latency=0.0, token_lifetime=3600):
+        self.latency = latency
+        self.token_lifetime = token_lifetime
+        self.verifications = 0
+
+    def verify_id_token(self, id_token, check_revoked=False):
+        self.verifications += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if not id_token or id_token == 'invalid':
+            raise ValueError('Invalid ID token')
+        return {'uid': 'benchmark-admin', 'email': 'benchmark@example.com', 'exp': time.time() + self.token_lifetime}
+
+
+def install(db, fake_auth):
+    """
+    Routes main.py's Firebase and Cloud Storage entry points to the fakes.
+    Must run before main.py is imported.
+    """
+    import firebase_admin
+    from firebase_admin import auth, credentials, firestore
+
+    credentials.ApplicationDefault = lambda: None
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    firestore.client = lambda *args, **kwargs: db
+    auth.verify_id_token = fake_auth.verify_id_token
+
+    # main.py creates a Storage client at import time, which needs credentials
+    from google.cloud import storage
+    storage.Client = lambda *args, **kwargs: None
@@ -0,0 +1,169 @@
+"""
+Recall/latency harness for the face index.
+
+Builds a synthetic roster of SFace-sized embeddings, runs the same queries
+through the exact float32 index and the IVF index, and reports how often the
+approximate index returns the same best student and the same
+recognized/unknown decision, together with per-query latency.
+
+With --storage float16 or int8 it also checks the compact embedding store:
+the largest distance error against float32, how many match decisions flip
+at the recognition threshold, and the memory held by the rows.
+
+Run from the face-recognition-service directory:
+
+    python benchmarks/index_recall.py --students 100000 --nprobe 8
+    python benchmarks/index_recall.py --students 500000 --storage int8
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from face_index import STORAGE_DTYPES, ExactIndex, IVFIndex, normalize_embeddings  # noqa: E402
+
+RECOGNITION_THRESHOLD = 0.68
+EMBEDDING_DIMENSION = 128
+
+
+def synthetic_roster(students, per_student, noise, rng):
+    """
+    Generates `per_student` noisy embeddings around a random identity
+    vector for every student. Returns the normalized matrix, the uid of
+    each row and the identity vectors.
+    """
+    identities = rng.standard_normal((students, EMBEDDING_DIMENSION)).astype(np.float32)
+    rows = np.repeat(identities, per_student, axis=0)
+    rows += noise * rng.standard_normal(rows.shape).astype(np.float32)
+    uids = np.repeat(np.array([f"student-{i:07d}" for i in range(students)], dtype=object), per_student)
+    return normalize_embeddings(rows), uids, identities
+
+
+def synthetic_queries(identities, count, noise, impostor_ratio, rng):
+    """
+    Generates live embeddings: most are noisy views of enrolled students,
+    the rest are impostors who are not enrolled at all. Returns the
+    normalized queries and a flag telling which ones are genuine.
+    """
+    impostors = int(count * impostor_ratio)
+    picks = rng.integers(0, len(identities), count - impostors)
+    known = identities[picks] + noise * rng.standard_normal((len(picks), EMBEDDING_DIMENSION)).astype(np.float32)
+    unknown = rng.standard_normal((impostors, EMBEDDING_DIMENSION)).astype(np.float32)
+    genuine = np.concatenate([np.ones(len(known), dtype=bool), np.zeros(impostors, dtype=bool)])
+    return normalize_embeddings(np.vstack([known, unknown])), genuine
+
+
+def run_queries(index, queries, k):
+    """Searches every query and records its latency."""
+    latencies = []
+    results = []
+    for query in queries:
+        started = time.perf_counter()
+        matches, scanned = index.search(query, k)
+        latencies.append(time.perf_counter() - started)
+        results.append((matches, scanned))
+    return results, np.array(latencies)
+
+
+def describe_latency(name, latencies):
+    """Prints latency percentiles in milliseconds."""
+    p50, p95, p99 = np.percentile(latencies * 1000, [50, 95, 99])
+    print(f"{name:>7}: p50 {p50:7.3f} ms | p95 {p95:7.3f} ms | p99 {p99:7.3f} ms")
+
+
+def check_storage(exact, compact, queries):
+    """
+    Compares a compact index against the float32 one: distance error over
+    every row and recognized/unknown decisions at the threshold.
+    """
+    max_error = 0.0
+    flipped = 0
+    changed_match = 0
+    for query in queries:
+        reference = exact.rows.distances(query)
+        approximate = compact.rows.distances(query)
+        max_error = max(max_error, float(np.abs(reference - approximate).max()))
+        exact_uid, exact_distance = exact.search(query, 1)[0][0]
+        compact_uid, compact_distance = compact.search(query, 1)[0][0]
+        if (exact_distance < RECOGNITION_THRESHOLD) != (compact_distance < RECOGNITION_THRESHOLD):
+            flipped += 1
+        elif exact_distance < RECOGNITION_THRESHOLD and exact_uid != compact_uid:
+            changed_match += 1
+
+    total = len(queries)
+    print(f"\nStorage {compact.rows.dtype} vs float32 (threshold {RECOGNITION_THRESHOLD}):")
+    print(f"  Max distance error:       {max_error:.5f}")
+    print(f"  Decisions flipped:        {flipped} of {total}")
+    print(f"  Recognized as another uid: {changed_match} of {total}")
+    print(f"  Row memory:               {compact.rows.nbytes / 2**20:.1f} MB "
+          f"(float32: {exact.rows.nbytes / 2**20:.1f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--students', type=int, default=20000)
+    parser.add_argument('--per-student', type=int, default=2)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--impostor-ratio', type=float, default=0.2)
+    parser.add_argument('--enroll-noise', type=float, default=0.35)
+    parser.add_argument('--query-noise', type=float, default=0.45)
+    parser.add_argument('--aggregation', choices=('min', 'mean'), default='min')
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('--storage', choices=STORAGE_DTYPES, default='float32',
+                        help='Also check this compact storage against float32')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    matrix, uids, identities = synthetic_roster(args.students, args.per_student, args.enroll_noise, rng)
+    queries, genuine = synthetic_queries(identities, args.queries, args.query_noise, args.impostor_ratio, rng)
+    print(f"Roster: {args.students} students x {args.per_student} embeddings = {len(matrix)} rows")
+
+    started = time.perf_counter()
+    exact = ExactIndex(matrix, uids, aggregation=args.aggregation)
+    print(f"Exact index built in {time.perf_counter() - started:.2f}s")
+    started = time.perf_counter()
+    ivf = IVFIndex(matrix, uids, aggregation=args.aggregation, nlist=args.nlist, nprobe=args.nprobe, seed=args.seed)
+    print(f"IVF index built in {time.perf_counter() - started:.2f}s "
+          f"({len(ivf.centroids)} lists, nprobe={ivf.nprobe})")
+
+    exact_results, exact_latencies = run_queries(exact, queries, 1)
+    ivf_results, ivf_latencies = run_queries(ivf, queries, 1)
+
+    genuine_agree = 0
+    decision_agree = 0
+    scanned = 0
+    for is_genuine, (exact_matches, _), (ivf_matches, ivf_scanned) in zip(genuine, exact_results, ivf_results):
+        scanned += ivf_scanned
+        exact_uid, exact_distance = exact_matches[0]
+        exact_decision = exact_uid if exact_distance < RECOGNITION_THRESHOLD else None
+        ivf_decision = None
+        if ivf_matches and ivf_matches[0][1] < RECOGNITION_THRESHOLD:
+            ivf_decision = ivf_matches[0][0]
+        if is_genuine and ivf_matches and ivf_matches[0][0] == exact_uid:
+            genuine_agree += 1
+        if exact_decision == ivf_decision:
+            decision_agree += 1
+
+    total = len(queries)
+    print(f"\nTop-1 recall vs exact (enrolled faces): {genuine_agree / max(1, int(genuine.sum())):.4f}")
+    print(f"Match decision agreement (all faces):   {decision_agree / total:.4f} (threshold {RECOGNITION_THRESHOLD})")
+    print(f"Embeddings scanned per query:           {scanned / total:.0f} of {len(matrix)}\n")
+    describe_latency('exact', exact_latencies)
+    describe_latency('ivf', ivf_latencies)
+
+    if args.storage != 'float32':
+        compact = ExactIndex(matrix, uids, aggregation=args.aggregation, storage=args.storage)
+        del matrix
+        _, compact_latencies = run_queries(compact, queries, 1)
+        describe_latency(args.storage, compact_latencies)
+        check_storage(exact, compact, queries)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+"""
+Offline benchmark of the /recognize pipeline.
+
+Stands in for Firestore and Firebase Auth with the in-memory fakes from
+fake_firebase.py, seeds a synthetic roster of SFace-sized embeddings,
+imports main.py as the service would run it, and replays frames through
+the Flask app as raw JPEG uploads. Reports, so regressions are visible
+without deploying:
+
+- p50/p95/p99 latency and throughput of every /recognize stage (taken from
+  the per-request log summary) and end to end
+- the cost of the initial roster load and of refresh_enrolled_faces_cache()
+- Firestore round-trips and token verifications during the replay
+- peak RSS after each phase
+
+Two pipelines are available. 'synthetic' (the default) keeps decoding,
+matching, profile lookup and attendance real but replaces face detection
+and SFace with a cheap crop and an embedding drawn near a random enrolled
+student (or an impostor), so it needs no model weights. 'model' runs the
+real detectors and SFace; pass --frames with recorded camera frames and
+each frame is also enrolled as a student so replays are recognized.
+
+--concurrency replays from several kiosk threads at once, which is where
+the inference scheduler batches embeddings. In the synthetic pipeline
+--synthetic-embed-ms gives every SFace forward pass a fixed cost, so the
+effect of batching shows up without model weights.
+
+Run from the face-recognition-service directory:
+
+    python benchmarks/recognize_pipeline.py --students 100000 --requests 500
+    python benchmarks/recognize_pipeline.py --pipeline model --frames recorded_frames/
+    python benchmarks/recognize_pipeline.py --concurrency 8 --synthetic-embed-ms 20
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_firebase import FakeAuth, FakeFirestore, install  # noqa: E402
+from face_index import normalize_embeddings  # noqa: E402
+from index_recall import EMBEDDING_DIMENSION  # noqa: E402
+
+STAGES = ('auth', 'decode', 'detection', 'embedding', 'session', 'matching', 'profile', 'attendance')
+FRAME_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+CLASSES = 24
+SHIFTS = {'Morning': '07:00', 'Afternoon': '13:00', 'Evening': '17:30'}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class SummaryCollector(logging.Handler):
+    """Keeps the structured fields of every 'Recognition finished' log record."""
+
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.summaries = []
+
+    def emit(self, record):
+        fields = getattr(record, 'fields', None)
+        if fields and 'stagesMs' in fields:
+            self.summaries.append(fields)
+
+
+def percentiles(values_ms):
+    if not values_ms:
+        return None
+    values = np.asarray(values_ms, dtype=np.float64)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    mean = float(values.mean())
+    return {
+        'count': len(values), 'p50': round(float(p50), 3), 'p95': round(float(p95), 3),
+        'p99': round(float(p99), 3), 'mean': round(mean, 3),
+        'perSecond': round(1000 / mean, 1) if mean > 0 else None,
+    }
+
+
+def synthetic_identities(students, shared_weight, rng):
+    """
+    Identity vectors with a component shared by every face. Real SFace
+    embeddings of different people are far from orthogonal, which is what
+    keeps the /recognize quality check (average distance to a few enrolled
+    rows) below its limit for genuine faces.
+    """
+    shared = rng.standard_normal(EMBEDDING_DIMENSION).astype(np.float32)
+    identities = rng.standard_normal((students, EMBEDDING_DIMENSION)).astype(np.float32)
+    identities += shared_weight * shared
+    return identities, shared
+
+
+def seed_firestore(db, args, rng):
+    started = time.perf_counter()
+    identities, shared = synthetic_identities(args.students, args.shared_weight, rng)
+    rows = np.repeat(identities, args.per_student, axis=0)
+    rows += args.enroll_noise * rng.standard_normal(rows.shape).astype(np.float32)
+    matrix = normalize_embeddings(rows)
+    del rows
+    student_uids = [f"student-{i:07d}" for i in range(args.students)]
+    row_offsets = np.arange(0, len(matrix) + 1, args.per_student)
+    shift_names = list(SHIFTS)
+    profiles = (
+        {'fullName': f"Student {i}", 'class': f"Class {i % CLASSES}", 'shift': shift_names[i % len(shift_names)]}
+        for i in range(args.students)
+    )
+    db.add_students(matrix, row_offsets, student_uids, profiles)
+    classes = db.collection('classes').docs
+    for class_id in range(CLASSES):
+        classes[str(class_id)] = {'shifts': {name: {'startTime': start} for name, start in SHIFTS.items()}}
+    print(f"Roster: {args.students} students x {args.per_student} embeddings = {len(matrix)} rows "
+          f"(generated in {time.perf_counter() - started:.1f}s)")
+    return identities, shared
+
+
+def load_frames(args, rng):
+    if args.frames:
+        paths = sorted(
+            os.path.join(args.frames, name) for name in os.listdir(args.frames)
+            if name.lower().endswith(FRAME_EXTENSIONS)
+        )
+        if not paths:
+            sys.exit(f"No {'/'.join(FRAME_EXTENSIONS)} frames found in {args.frames}")
+        frames = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                frames.append(f.read())
+        print(f"Frames: {len(frames)} recorded frames from {args.frames}")
+        return frames
+
+    width, height = (int(side) for side in args.frame_size.split('x'))
+    frames = []
+    for _ in range(args.synthetic_frames):
+        # Smooth gradients plus noise compress like a camera frame, unlike pure noise
+        y, x = np.mgrid[0:height, 0:width]
+        base = np.stack([x * 255 / width, y * 255 / height, (x + y) * 127 / (width + height)], axis=-1)
+        pixels = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, 'JPEG', quality=85)
+        frames.append(buffer.getvalue())
+    print(f"Frames: {len(frames)} synthetic {args.frame_size} JPEGs "
+          f"(~{np.mean([len(frame) for frame in frames]) / 1024:.0f} KB each)")
+    return frames
+
+
+def wait_for_index(main, timeout):
+    started = time.perf_counter()
+    while main.enrolled_faces.index is None:
+        if time.perf_counter() - started > timeout:
+            sys.exit("Timed out waiting for the enrolled faces index")
+        time.sleep(0.05)
+    return time.perf_counter() - started
+
+
+def use_synthetic_models(main, identities, shared, args, rng):
+    """
+    Replaces detection and SFace with cheap stand-ins. Every detected face
+    gets its embedding drawn at detection time, so requests from several
+    threads (batched together by the scheduler) keep their own embeddings.
+    """
+    embeddings = {}
+    lock = threading.Lock()
+
+    def extract_face(img_array, detector_backend='opencv', enforce_detection=False):
+        face = img_array[None, :112, :112].astype(np.float32) / 255
+        with lock:
+            if rng.random() < args.impostor_ratio:
+                embedding = rng.standard_normal(EMBEDDING_DIMENSION) + args.shared_weight * shared
+            else:
+                embedding = identities[rng.integers(len(identities))] + args.query_noise * rng.standard_normal(EMBEDDING_DIMENSION)
+            embeddings[id(face)] = embedding.astype(np.float32)
+        return [face]
+
+    def embed(faces):
+        if args.synthetic_embed_ms:
+            time.sleep(args.synthetic_embed_ms / 1000)
+        with lock:
+            return [embeddings.pop(id(face)) for face in faces]
+
+    main.extract_face = extract_face
+    main.sface_embedder.embed = embed
+
+
+def enroll_frames(main, db, frames):
+    """Enrolls every recorded frame as an extra student using the real models."""
+    students = db.collection('students').docs
+    enrolled = 0
+    for i, frame in enumerate(frames):
+        img_array = main.load_image_array(frame, main.IMAGE_MAX_SIDE)
+        faces = main.extract_face(img_array, detector_backend='opencv', enforce_detection=False)
+        if not faces:
+            continue
+        embedding = main.sface_embedder.embed(faces[:1])[0]
+        students[f"frame-doc-{i:05d}"] = {
+            'authUid': f"frame-{i:05d}", 'fullName': f"Frame {i}", 'class': 'Class 0', 'shift': 'Morning',
+            'facialEmbeddings': [{'embedding': list(map(float, embedding))}],
+        }
+        enrolled += 1
+    print(f"Enrolled {enrolled} of {len(frames)} recorded frames as students")
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--students', type=int, default=10000, help='Roster size (1k to 500k)')
+    parser.add_argument('--per-student', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=1, help='Kiosk threads replaying at once')
+    parser.add_argument('--pipeline', choices=('synthetic', 'model'), default='synthetic')
+    parser.add_argument('--frames', help='Directory of recorded JPEG/PNG frames to replay')
+    parser.add_argument('--synthetic-frames', type=int, default=8)
+    parser.add_argument('--synthetic-embed-ms', type=float, default=0.0,
+                        help='Fixed cost of one synthetic SFace forward pass, whatever the batch size')
+    parser.add_argument('--frame-size', default='1280x720')
+    parser.add_argument('--impostor-ratio', type=float, default=0.1)
+    parser.add_argument('--enroll-noise', type=float, default=0.35)
+    parser.add_argument('--query-noise', type=float, default=0.25)
+    parser.add_argument('--shared-weight', type=float, default=0.5,
+                        help='Weight of the component shared by all synthetic faces')
+    parser.add_argument('--index-mode', choices=('exact', 'ivf'), default=os.environ.get('FACE_INDEX_MODE', 'exact'))
+    parser.add_argument('--storage', choices=('float32', 'float16', 'int8'),
+                        default=os.environ.get('FACE_INDEX_STORAGE', 'float32'))
+    parser.add_argument('--firestore-latency-ms', type=float, default=20.0,
+                        help='Artificial latency of every Firestore round-trip')
+    parser.add_argument('--verify-latency-ms', type=float, default=10.0,
+                        help='Artificial cost of one ID token verification')
+    parser.add_argument('--refresh-runs', type=int, default=1, help='Timed refresh_enrolled_faces_cache() calls')
+    parser.add_argument('--log-level', default='WARNING', help="Service log level during the run")
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    db = FakeFirestore(latency=args.firestore_latency_ms / 1000)
+    fake_auth = FakeAuth(latency=args.verify_latency_ms / 1000)
+    identities, shared = seed_firestore(db, args, rng)
+    frames = load_frames(args, rng)
+    results = {'config': vars(args), 'peakRssMb': {'roster': round(peak_rss_mb(), 1)}}
+
+    install(db, fake_auth)
+    os.environ['FACE_INDEX_MODE'] = args.index_mode
+    os.environ['FACE_INDEX_STORAGE'] = args.storage
+    os.environ['WARMUP_MODE'] = 'blocking' if args.pipeline == 'model' else 'off'
+    os.environ['EMBEDDINGS_SNAPSHOT_DIR'] = ''
+    os.environ['LOG_FORMAT'] = 'text'
+    os.environ['LOG_LEVEL'] = 'INFO'
+
+    started = time.perf_counter()
+    import main
+    import_seconds = time.perf_counter() - started
+    for handler in logging.getLogger().handlers:
+        handler.setLevel(args.log_level.upper())
+    collector = SummaryCollector()
+    main.logger.addHandler(collector)
+
+    initial_load = wait_for_index(main, timeout=3600)
+    results['initialLoadSeconds'] = round(import_seconds + initial_load, 3)
+    results['peakRssMb']['loaded'] = round(peak_rss_mb(), 1)
+    print(f"Service imported in {import_seconds:.2f}s, roster loaded {initial_load:.2f}s later "
+          f"({len(main.enrolled_faces.index)} embeddings, {main.enrolled_faces.index.mode} index)")
+
+    if args.pipeline == 'synthetic':
+        use_synthetic_models(main, identities, shared, args, rng)
+    else:
+        if args.frames:
+            enroll_frames(main, db, frames)
+        else:
+            print("Note: synthetic frames contain no faces; the model pipeline measures the no-face path only.")
+
+    refresh_seconds = []
+    for _ in range(args.refresh_runs):
+        started = time.perf_counter()
+        main.refresh_enrolled_faces_cache()
+        refresh_seconds.append(time.perf_counter() - started)
+    if refresh_seconds:
+        results['refreshSeconds'] = {'runs': [round(seconds, 3) for seconds in refresh_seconds],
+                                     'mean': round(float(np.mean(refresh_seconds)), 3)}
+        print(f"refresh_enrolled_faces_cache(): {np.mean(refresh_seconds):.2f}s mean over {len(refresh_seconds)} run(s)")
+    results['peakRssMb']['refreshed'] = round(peak_rss_mb(), 1)
+
+    headers = {'Authorization': 'Bearer benchmark-token', 'Content-Type': 'image/jpeg'}
+    round_trips_before = db.round_trips
+    verifications_before = fake_auth.verifications
+    request_ms = []
+    outcomes = {}
+    results_lock = threading.Lock()
+
+    def replay(i):
+        client = main.app.test_client()
+        started = time.perf_counter()
+        response = client.post('/recognize', data=frames[i % len(frames)], headers=headers)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        outcome = (response.get_json(silent=True) or {}).get('status') or f"http {response.status_code}"
+        with results_lock:
+            request_ms.append(elapsed_ms)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    replay_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(replay, range(args.requests)))
+    replay_seconds = time.perf_counter() - replay_started
+
+    started = time.perf_counter()
+    main.attendance_ledger.flush()
+    flush_seconds = time.perf_counter() - started
+    results['peakRssMb']['replayed'] = round(peak_rss_mb(), 1)
+
+    stage_ms = {stage: [] for stage in STAGES}
+    for summary in collector.summaries:
+        for stage, milliseconds in summary['stagesMs'].items():
+            stage_ms.setdefault(stage, []).append(milliseconds)
+    results['stages'] = {stage: percentiles(values) for stage, values in stage_ms.items() if values}
+    results['endToEnd'] = percentiles(request_ms)
+    results['throughputPerSecond'] = round(args.requests / replay_seconds, 1)
+    results['outcomes'] = outcomes
+    results['firestoreRoundTripsDuringReplay'] = db.round_trips - round_trips_before
+    results['tokenVerificationsDuringReplay'] = fake_auth.verifications - verifications_before
+    results['attendanceFlushSeconds'] = round(flush_seconds, 3)
+    results['inference'] = main.inference_scheduler.stats()
+
+    print(f"\nReplayed {args.requests} requests in {replay_seconds:.2f}s "
+          f"({results['throughputPerSecond']} req/s, {args.pipeline} pipeline, concurrency {args.concurrency})")
+    print(f"Outcomes: {outcomes}")
+    print(f"Inference batches: {results['inference']['batches']}, "
+          f"average batch size: {results['inference']['avgBatchSize']}")
+    print(f"Firestore round-trips during replay (background writer included): {results['firestoreRoundTripsDuringReplay']}, "
+          f"token verifications: {results['tokenVerificationsDuringReplay']}, "
+          f"attendance flush: {flush_seconds * 1000:.1f} ms\n")
+    print(f"{'stage':>12} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'per s':>9}")
+    for stage, stats in list(results['stages'].items()) + [('end-to-end', results['endToEnd'])]:
+        print(f"{stage:>12} {stats['count']:>6} {stats['p50']:>9.3f} {stats['p95']:>9.3f} "
+              f"{stats['p99']:>9.3f} {stats['perSecond'] or 0:>9.1f}")
+    print("\nPeak RSS (MB): " + ', '.join(f"{phase} {mb}" for phase, mb in results['peakRssMb'].items()))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == '__main__':
+    main_benchmark()
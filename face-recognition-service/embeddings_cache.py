@@ -0,0 +1,593 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from embeddings_snapshot import load_snapshot, write_snapshot
+from face_index import IVF_MIN_ROWS, IVFIndex, RowSource, build_index, normalize_embeddings
+from metrics import Histogram
+from shared_index import LeaderLock, current_version, load_published_index, publish_index
+
+logger = logging.getLogger(__name__)
+
+# Field bumped by the enrollment function whenever 'facialEmbeddings' changes
+EMBEDDINGS_UPDATED_FIELD = 'facialEmbeddingsUpdatedAt'
+# The catch-up query starts this long before the high-water mark, so writes
+# committed around the time the snapshot was taken are not missed. Applying
+# a change twice is harmless.
+HIGH_WATER_MARK_OVERLAP = timedelta(seconds=60)
+# Student fields /recognize needs after a match (response and attendance status)
+PROFILE_FIELDS = ('fullName', 'class', 'shift', 'phone', 'gracePeriodMinutes', 'gradePeriodMinutes')
+
+# 'full' reloads stream every student, 'rebuild' swaps in an index after
+# listener changes, 'snapshot' maps the on-disk snapshot at boot, 'shared'
+# maps an index published by the leader worker
+embeddings_refresh_seconds = Histogram(
+    'embeddings_refresh_seconds', 'Duration of enrolled faces cache refreshes.', ['kind'])
+
+
+class StudentProfile:
+    """The document id and the PROFILE_FIELDS of one enrolled student."""
+
+    __slots__ = ('doc_id', 'data')
+
+    def __init__(self, doc_id, data):
+        self.doc_id = doc_id
+        self.data = data
+
+
+def update_time_key(student_data):
+    """
+    The student's EMBEDDINGS_UPDATED_FIELD as a Unix timestamp, or None, so
+    it can be compared and stored in a snapshot.
+    """
+    updated_at = student_data.get(EMBEDDINGS_UPDATED_FIELD) if student_data else None
+    return updated_at.timestamp() if hasattr(updated_at, 'timestamp') else None
+
+
+def student_profile(doc_id, student_data):
+    return StudentProfile(doc_id, {field: student_data[field] for field in PROFILE_FIELDS if student_data.get(field) is not None})
+
+
+def parse_student_embeddings(doc_id, student_data, dtype=np.float32):
+    """
+    Extracts the authUid, the normalized embedding rows (as `dtype`) and the
+    profile from a student document. Returns None when the student cannot be
+    matched (no authUid or no usable embeddings).
+    """
+    auth_uid = student_data.get("authUid")
+    # We must have an authUid to perform the final lookup
+    if not auth_uid:
+        logger.debug("Skipping student %s because they are missing an authUid.", doc_id)
+        return None
+
+    # A student can have multiple embeddings. We need to cache all of them.
+    vectors = []
+    for embedding_obj in student_data.get("facialEmbeddings") or []:
+        if isinstance(embedding_obj, dict) and 'embedding' in embedding_obj:
+            embedding_vector = embedding_obj['embedding']
+            if vectors and len(embedding_vector) != len(vectors[0]):
+                logger.debug("Skipping embedding for student %s with unexpected dimension %d.", doc_id, len(embedding_vector))
+                continue
+            vectors.append(embedding_vector)
+
+    if not vectors:
+        return None
+    rows = normalize_embeddings(vectors).astype(dtype, copy=False)
+    return auth_uid, rows, student_profile(doc_id, student_data)
+
+
+def snapshot_students(snapshot):
+    """(doc_id, authUid, profile data, update time) of a loaded snapshot's students."""
+    uid_table = snapshot.index.uid_table
+    return [
+        (doc_id, uid_table[uid_code], profile, updated_at)
+        for doc_id, uid_code, profile, updated_at
+        in zip(snapshot.doc_ids, snapshot.student_uid_codes, snapshot.profiles, snapshot.updated_at)
+    ]
+
+
+def snapshot_profiles(snapshot):
+    """authUid -> StudentProfile of a loaded snapshot, first student per authUid."""
+    profiles = {}
+    for doc_id, auth_uid, profile, _ in snapshot_students(snapshot):
+        profiles.setdefault(auth_uid, StudentProfile(doc_id, profile))
+    return profiles
+
+
+class EnrolledFacesCache:
+    """
+    In-memory roster of enrolled embeddings, kept up to date off the request
+    path.
+
+    A background thread streams the enrolled students once, then subscribes
+    a Firestore snapshot listener to the students whose embeddings changed
+    after the high-water mark and applies every change it delivers as a
+    delta to the roster. The listener never watches the whole collection:
+    Firestore keeps every document a listener matches decoded in memory,
+    embeddings included, for as long as it is attached. Changes are
+    coalesced for a short debounce window, the new face index is built on
+    the background thread and then swapped in with a single reference
+    assignment, so requests always see a complete index and never wait for
+    a refresh. Every `refresh_interval` seconds the roster is re-streamed
+    and the listener moved to the new high-water mark; if the client cannot
+    listen (e.g. a fake client without `on_snapshot`), that periodic reload
+    is the only refresh.
+
+    With a `snapshot_dir`, the search-ready index is also persisted as a
+    memory-mapped snapshot (see embeddings_snapshot.py). A starting worker
+    maps the snapshot and serves from it immediately, then only listens for
+    students whose embeddings changed after the snapshot's high-water mark.
+    A snapshot written with other index settings is rebuilt once instead.
+
+    The same documents also feed `profiles`, an authUid -> StudentProfile
+    map swapped in together with the index, so the post-match lookup needs
+    no Firestore query. Profile edits that do not touch the embeddings reach
+    a snapshot-booted worker with the next full resync.
+
+    The index is the only copy of the roster's embeddings. Changes wait in a
+    small pending map until the next rebuild, which takes the rows of every
+    unchanged student straight from the current index (see RowSource) and
+    only adds the rows of the changed ones. A full reload holds the streamed
+    rows as float16 when the index stores compact rows
+    (index_options['storage'] other than 'float32'), until they are indexed.
+
+    With a `shared_dir` (see shared_index.py), only the worker holding the
+    leader lock runs the refresher; it publishes every new index there and
+    serves from the mapped copy. The other workers never query Firestore for
+    embeddings: they map each version the leader publishes, checking every
+    `shared_poll_interval` seconds, and the first to find the lock free
+    takes over as leader. It starts from the last published version the way
+    a worker boots from the snapshot, catching up from its high-water mark.
+    """
+
+    def __init__(self, db, index_options, refresh_interval=3600, debounce=0.5,
+                 snapshot_dir=None, snapshot_interval=300, shared_dir=None, shared_poll_interval=1.0):
+        self.db = db
+        self.index_options = index_options
+        self.refresh_interval = refresh_interval
+        self.debounce = debounce
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_interval = snapshot_interval
+        self.shared_dir = shared_dir
+        self.shared_poll_interval = shared_poll_interval
+        self.roster_dtype = np.float32 if index_options.get('storage', 'float32') == 'float32' else np.float16
+        # Current search index; replaced as a whole, never mutated in place
+        self.index = None
+        # authUid -> StudentProfile of every student in the index
+        self.profiles = {}
+        # Timestamp of the last index swap
+        self.last_refresh = 0
+        self.listening = False
+        # Latest EMBEDDINGS_UPDATED_FIELD value seen in Firestore
+        self.high_water_mark = None
+
+        # student document id -> (authUid, normalized embedding rows, profile), or
+        # None for a removal, of the changes the index does not reflect yet
+        self._pending = {}
+        # student document id -> update time (see update_time_key) of every
+        # student in the roster, so re-delivered changes can be skipped
+        self._updated_at = {}
+        self._students_lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._watch = None
+        self._snapshot_pending = False
+        self._last_snapshot_write = 0
+        self._thread = None
+        self._leader_lock = LeaderLock(shared_dir) if shared_dir else None
+        # Name of the shared index version currently mapped
+        self._shared_version = None
+        # (doc_id, authUid, profile data, update time) of the students in the current index,
+        # ordered as its row_ids count them, and the high-water mark it reflects
+        self._indexed_students = []
+        self._indexed_high_water_mark = None
+
+    @property
+    def role(self):
+        """'leader' or 'follower' with a shared index, otherwise None."""
+        if self._leader_lock is None:
+            return None
+        return 'leader' if self._leader_lock.held else 'follower'
+
+    def _students_query(self):
+        # Query for all students that have the 'facialEmbeddings' field.
+        return self.db.collection('students').where("facialEmbeddings", "!=", [])
+
+    def _changed_students_query(self, since):
+        return self.db.collection('students').where(EMBEDDINGS_UPDATED_FIELD, ">", since - HIGH_WATER_MARK_OVERLAP)
+
+    def _observe_update_time(self, student_data):
+        updated_at = student_data.get(EMBEDDINGS_UPDATED_FIELD) if student_data else None
+        if updated_at is not None and (self.high_water_mark is None or updated_at > self.high_water_mark):
+            self.high_water_mark = updated_at
+
+    def load_snapshot(self, root=None):
+        """
+        Maps the on-disk snapshot (or the one in `root`, e.g. the shared
+        dir) and serves its index right away; later rebuilds start from its
+        rows. Returns True if a snapshot was loaded.
+        """
+        root = root or self.snapshot_dir
+        if not root:
+            return False
+        try:
+            started = time.perf_counter()
+            snapshot = load_snapshot(root)
+            if snapshot is None:
+                return False
+
+            with self._students_lock:
+                self._pending = {}
+                self._updated_at = dict(zip(snapshot.doc_ids, snapshot.updated_at))
+                self.high_water_mark = snapshot.high_water_mark
+            # The catch-up listener re-delivers the latest changes; they are
+            # skipped, and a real change waits the usual interval to be written
+            self._last_snapshot_write = time.time()
+            index = snapshot.index
+            self._indexed_students = snapshot_students(snapshot)
+            self._indexed_high_water_mark = snapshot.high_water_mark
+            if not self._index_matches_options(index):
+                logger.info("Embeddings snapshot %s was built with other index settings (%s %s/%s); rebuilding it",
+                            snapshot.path, index.mode, index.rows.dtype, index.aggregation)
+                # Served, and rebuilt from, until the new index is ready
+                self.profiles = snapshot_profiles(snapshot)
+                self.index = index
+                self.rebuild(retrain=True)
+                return True
+
+            if isinstance(index, IVFIndex):
+                index.nprobe = min(self.index_options.get('nprobe', 8), len(index.centroids))
+            if root == self.shared_dir:
+                # Already published; the snapshot dir may lag behind it
+                self._shared_version = os.path.basename(snapshot.path)
+                self._snapshot_pending = bool(self.snapshot_dir)
+                self.profiles = snapshot_profiles(snapshot)
+                self.index = index
+                self.last_refresh = time.time()
+            else:
+                self._swap(index, snapshot_profiles(snapshot))
+            embeddings_refresh_seconds.observe(time.perf_counter() - started,
+                                               kind='shared' if root == self.shared_dir else 'snapshot')
+            logger.info("Loaded embeddings snapshot %s: %d embeddings for %d students in %.3fs (high-water mark: %s)",
+                        snapshot.path, len(index), index.student_count, time.perf_counter() - started,
+                        snapshot.high_water_mark)
+            return True
+        except Exception:
+            logger.warning("Could not load embeddings snapshot from %s", root, exc_info=True)
+            return False
+
+    def _index_matches_options(self, index):
+        """True if a restored index was built with the configured settings."""
+        options = self.index_options
+        if index.rows.dtype != options.get('storage', 'float32') or index.aggregation != options.get('aggregation', 'min'):
+            return False
+        if index.mode == options.get('mode', 'exact'):
+            return True
+        # build_index() itself falls back to the exact index for small rosters
+        return index.mode == 'exact' and len(index) < IVF_MIN_ROWS
+
+    def reload(self):
+        """
+        Re-streams every student with embeddings and rebuilds the index.
+        This is the slow full refresh; it runs on the background thread.
+        """
+        logger.info("Refreshing face embeddings cache")
+
+        if not self.db:
+            logger.error("Firestore client not available. Skipping cache refresh.")
+            return
+
+        try:
+            started = time.perf_counter()
+            students = {}
+            updated_at = {}
+            for student in self._students_query().stream():
+                student_data = student.to_dict()
+                self._observe_update_time(student_data)
+                parsed = parse_student_embeddings(student.id, student_data, self.roster_dtype)
+                if parsed:
+                    students[student.id] = parsed
+                    updated_at[student.id] = update_time_key(student_data)
+
+            with self._students_lock:
+                self._pending = students
+                self._updated_at = updated_at
+            self.rebuild(retrain=True, keep_rows=False)
+
+            embeddings_refresh_seconds.observe(time.perf_counter() - started, kind='full')
+            logger.info("Cache refresh completed in %.2fs", time.perf_counter() - started)
+
+        except Exception:
+            logger.exception("Error during cache refresh")
+
+    def apply_changes(self, changes):
+        """
+        Queues (doc_id, student_data) deltas for the next rebuild. A student_data of
+        None, or a document without usable embeddings, removes the student.
+        Changes the roster already reflects (an update time no newer than
+        the one it holds, or removing a student it does not have) are
+        skipped, and only a real change schedules a rebuild.
+        """
+        parsed_changes = []
+        for doc_id, student_data in changes:
+            self._observe_update_time(student_data)
+            updated_at = update_time_key(student_data)
+            known = doc_id in self._updated_at
+            known_updated_at = self._updated_at.get(doc_id)
+            if updated_at is not None and known_updated_at is not None and updated_at <= known_updated_at:
+                continue
+            parsed = parse_student_embeddings(doc_id, student_data, self.roster_dtype) if student_data else None
+            if parsed or known:
+                parsed_changes.append((doc_id, parsed, updated_at))
+        if not parsed_changes:
+            return
+
+        with self._students_lock:
+            for doc_id, parsed, updated_at in parsed_changes:
+                self._pending[doc_id] = parsed
+                if parsed:
+                    self._updated_at[doc_id] = updated_at
+                else:
+                    self._updated_at.pop(doc_id, None)
+
+        self._dirty.set()
+
+    def rebuild(self, retrain=False, keep_rows=True):
+        """
+        Applies the pending changes to the current index (or, without
+        `keep_rows`, builds one from the pending students alone) and swaps
+        the result in. IVF centroids are reused between incremental rebuilds
+        and only retrained on full reloads.
+        """
+        with self._rebuild_lock:
+            started = time.perf_counter()
+            with self._students_lock:
+                pending, self._pending = self._pending, {}
+                updated_at = dict(self._updated_at)
+                high_water_mark = self.high_water_mark
+            try:
+                previous = self.index if keep_rows else None
+                matrix, uids, row_ids, students, profiles = self._roster(previous, pending, updated_at)
+
+                centroids = None
+                if not retrain and isinstance(previous, IVFIndex) and previous.centroids.shape[1] == matrix.shape[1]:
+                    centroids = previous.centroids
+
+                index = build_index(matrix, uids, centroids=centroids, row_ids=row_ids, **self.index_options)
+            except Exception:
+                # Retried with the next rebuild; changes queued since take precedence
+                with self._students_lock:
+                    for doc_id, parsed in pending.items():
+                        self._pending.setdefault(doc_id, parsed)
+                raise
+            self._indexed_students = students
+            self._indexed_high_water_mark = high_water_mark
+            index = self._swap(index, profiles)
+            self._snapshot_pending = bool(self.snapshot_dir)
+            embeddings_refresh_seconds.observe(time.perf_counter() - started, kind='rebuild')
+            logger.info("Face index swapped: %d embeddings for %d students (%s index, built in %.2fs)",
+                        len(index), index.student_count, index.mode, time.perf_counter() - started)
+
+    def _roster(self, previous, pending, updated_at):
+        """
+        The rows of a new index: those of `previous` whose students have no
+        pending change, followed by the rows of the pending students. Returns
+        the matrix (a RowSource when rows are kept), the authUid and the
+        student position of every row, the (doc_id, authUid, profile data,
+        update time) students and the authUid -> StudentProfile map.
+        """
+        parts = []
+        uids = []
+        row_ids = []
+        students = []
+        profiles = {}
+        dimension = None
+        if previous is not None and len(previous):
+            dimension = previous.rows.rows.shape[1]
+            kept = np.array([doc_id not in pending for doc_id, *_ in self._indexed_students], dtype=bool)
+            rows = np.flatnonzero(kept[previous.row_ids])
+            parts.append((previous.rows, rows))
+            uids.append(previous.uid_table[previous.uid_codes[rows]])
+            # Kept students are renumbered in their previous order
+            row_ids.append((np.cumsum(kept) - 1)[previous.row_ids[rows]])
+            for position in np.flatnonzero(kept):
+                doc_id, auth_uid, profile, _ = self._indexed_students[position]
+                students.append(self._indexed_students[position])
+                profiles.setdefault(auth_uid, StudentProfile(doc_id, profile))
+
+        blocks = []
+        added_uids = []
+        for doc_id, parsed in pending.items():
+            if not parsed:
+                continue
+            auth_uid, rows, profile = parsed
+            if dimension is not None and rows.shape[1] != dimension:
+                continue
+            dimension = rows.shape[1]
+            blocks.append(rows)
+            added_uids.extend([auth_uid] * len(rows))
+            profiles.setdefault(auth_uid, profile)
+            students.append((doc_id, auth_uid, profile.data, updated_at.get(doc_id)))
+        if blocks:
+            added = np.concatenate(blocks)
+            parts.append((added, np.arange(len(added))))
+            uids.append(np.array(added_uids, dtype=object))
+            # The snapshot finds every row's student again through these ids
+            row_ids.append(np.repeat(np.arange(len(students) - len(blocks), len(students)), [len(rows) for rows in blocks]))
+
+        if not parts:
+            return np.empty((0, 0), dtype=np.float32), [], np.empty(0, dtype=np.int32), students, profiles
+        # A full reload indexes the streamed rows as they are
+        matrix = added if len(parts) == 1 and blocks else RowSource(parts, dimension)
+        return matrix, np.concatenate(uids), np.concatenate(row_ids).astype(np.int32), students, profiles
+
+    def _swap(self, index, profiles):
+        """
+        Makes a newly built index current and returns the index now served.
+        The leader of a shared index publishes it first and then serves the
+        mapped copy, so the private one can be freed.
+        """
+        if self.role == 'leader':
+            try:
+                path = publish_index(self.shared_dir, index, self._indexed_students,
+                                     high_water_mark=self._indexed_high_water_mark)
+                published = load_published_index(self.shared_dir)
+                self._shared_version = os.path.basename(path)
+                index = published.index
+            except Exception:
+                logger.exception("Could not publish the face index to %s; serving the private copy", self.shared_dir)
+        self.profiles = profiles
+        self.index = index
+        self.last_refresh = time.time()
+        return index
+
+    def load_published(self):
+        """
+        Maps the index the leader published last, if it is newer than the
+        one in use. Returns True if a new version was swapped in.
+        """
+        if current_version(self.shared_dir) in (None, self._shared_version):
+            return False
+        try:
+            started = time.perf_counter()
+            published = load_published_index(self.shared_dir)
+            if published is None:
+                return False
+            self._shared_version = os.path.basename(published.path)
+            self.high_water_mark = published.high_water_mark
+            self.profiles = snapshot_profiles(published)
+            self.index = published.index
+            self.last_refresh = time.time()
+            embeddings_refresh_seconds.observe(time.perf_counter() - started, kind='shared')
+            logger.info("Mapped shared face index %s: %d embeddings for %d students in %.3fs",
+                        self._shared_version, len(published.index), published.index.student_count,
+                        time.perf_counter() - started)
+            return True
+        except Exception:
+            # E.g. the version was replaced while being mapped; retried on the next poll
+            logger.warning("Could not map the shared face index in %s", self.shared_dir, exc_info=True)
+            return False
+
+    def _follow(self):
+        """Follower loop: maps new published versions until this worker can lead."""
+        while not self._leader_lock.acquire():
+            self.load_published()
+            time.sleep(self.shared_poll_interval)
+
+        logger.info("Worker %d took over as the embeddings leader", os.getpid())
+        # The last published version is at least as recent as the snapshot
+        if not self.load_snapshot(self.shared_dir) and not self.load_snapshot():
+            # Nothing to rebuild from; stream the roster from Firestore
+            self.high_water_mark = None
+        if self.db:
+            self._run()
+
+    def write_snapshot(self):
+        """
+        Persists the current index, its students and the high-water mark it
+        reflects to the snapshot dir. Runs on the refresher thread, the only
+        one that swaps indexes.
+        """
+        self._snapshot_pending = False
+        self._last_snapshot_write = time.time()
+        try:
+            started = time.perf_counter()
+            path = write_snapshot(self.snapshot_dir, self.index, self._indexed_students,
+                                  high_water_mark=self._indexed_high_water_mark)
+            logger.info("Wrote embeddings snapshot %s in %.2fs", path, time.perf_counter() - started)
+        except Exception:
+            logger.exception("Error writing embeddings snapshot")
+
+    def _on_snapshot(self, doc_snapshots, changes, read_time):
+        """Firestore listener callback; runs on the listener's own thread."""
+        try:
+            # The first snapshot of a subscription delivers every match as ADDED;
+            # re-applying students the roster already holds is harmless
+            deltas = []
+            for change in changes:
+                student_data = None if change.type.name == 'REMOVED' else change.document.to_dict()
+                deltas.append((change.document.id, student_data))
+            if deltas:
+                logger.debug("Snapshot listener delivered %d student changes.", len(deltas))
+                self.apply_changes(deltas)
+        except Exception:
+            logger.exception("Error applying snapshot changes")
+
+    def _subscribe(self):
+        """
+        (Re)subscribes the snapshot listener to the students changed after
+        the high-water mark (or after now, if no student carries the field
+        yet). Returns False if the client does not support listeners.
+        """
+        if self._watch is not None:
+            try:
+                self._watch.unsubscribe()
+            except Exception:
+                pass
+            self._watch = None
+        since = self.high_water_mark or datetime.now(timezone.utc)
+        try:
+            self._watch = self._changed_students_query(since).on_snapshot(self._on_snapshot)
+            logger.debug("Listening for embedding changes since %s.", since)
+            return True
+        except Exception as e:
+            logger.warning("Snapshot listener unavailable, falling back to periodic reloads: %s", e)
+            return False
+
+    def _run(self):
+        if self.index is None or self.high_water_mark is None:
+            self.reload()
+        # Booted from a snapshot, the first listener snapshot catches up on
+        # the changes made since it was taken
+        self.listening = self._subscribe()
+
+        next_resync = time.time() + self.refresh_interval
+        while True:
+            wake_at = next_resync
+            if self._snapshot_pending:
+                wake_at = min(wake_at, self._last_snapshot_write + self.snapshot_interval)
+            if self._dirty.wait(max(0.0, wake_at - time.time())):
+                # Give bursts of changes (e.g. bulk enrollment) a moment to coalesce
+                time.sleep(self.debounce)
+                self._dirty.clear()
+                try:
+                    self.rebuild()
+                except Exception:
+                    logger.exception("Error rebuilding face index")
+                continue
+
+            if self._snapshot_pending and time.time() >= self._last_snapshot_write + self.snapshot_interval:
+                self.write_snapshot()
+            if time.time() < next_resync:
+                continue
+
+            # Periodic resync guards against a listener that silently stopped
+            # and picks up students written without the updated-at field. The
+            # new listener re-delivers changes made while the stream ran.
+            next_resync = time.time() + self.refresh_interval
+            self.reload()
+            if self.listening:
+                self.listening = self._subscribe()
+
+    def start(self):
+        """
+        Maps the snapshot (if any) and starts the background refresher
+        thread (once). With a shared index, a worker that cannot take the
+        leader lock maps the published index and follows it instead.
+        """
+        if self._thread is not None:
+            return
+        if self._leader_lock is not None and not self._leader_lock.acquire():
+            self.load_published()
+            self._thread = threading.Thread(target=self._follow, name='embeddings-follower', daemon=True)
+            self._thread.start()
+            return
+        self.load_snapshot()
+        if not self.db:
+            return
+        self._thread = threading.Thread(target=self._run, name='embeddings-refresher', daemon=True)
+        self._thread.start()
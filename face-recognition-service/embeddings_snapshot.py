@@ -0,0 +1,172 @@
+"""
+On-disk snapshot of the enrolled embeddings roster.
+
+A snapshot holds the search-ready face index, so a booting worker maps it
+and serves without rebuilding, quantizing or re-clustering anything. It is
+a directory holding:
+
+    header.json      format name/version, index settings, high-water mark
+    rows.npy         index rows in search order and storage dtype
+    scales.npy       (int8 storage) per-row scales
+    uid_codes.npy    authUid code of every row
+    row_ids.npy      position of every row's student in students.json
+    sample_rows.npy  rows used by the /recognize quality check
+    centroids.npy,
+    list_offsets.npy (IVF) cluster centroids and row ranges
+    students.json    student document ids, interned authUid table, the
+                     authUid code, the profile fields and the embeddings
+                     update time (Unix seconds) of every student
+
+Snapshots live in versioned subdirectories of the snapshot root. The file
+`CURRENT` names the active one and is replaced atomically, so readers never
+see a half-written snapshot. The arrays are opened with mmap, which makes
+loading independent of the roster size.
+"""
+import json
+import logging
+import os
+import shutil
+import time
+from datetime import datetime
+
+import numpy as np
+
+from face_index import index_arrays, restore_index
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 'face-embeddings'
+SNAPSHOT_FORMAT_VERSION = 4
+# Versions kept on disk besides the current one, for readers that resolved
+# CURRENT just before it moved
+PREVIOUS_SNAPSHOTS_TO_KEEP = 1
+
+
+class EmbeddingsSnapshot:
+    """A loaded (memory-mapped) snapshot."""
+
+    def __init__(self, path, header, index, doc_ids, student_uid_codes, profiles, updated_at):
+        self.path = path
+        self.header = header
+        self.index = index
+        self.doc_ids = doc_ids
+        self.student_uid_codes = student_uid_codes
+        self.profiles = profiles
+        self.updated_at = updated_at
+
+    @property
+    def high_water_mark(self):
+        value = self.header.get('high_water_mark')
+        return datetime.fromisoformat(value) if value else None
+
+
+def write_snapshot(root, index, students, high_water_mark=None, previous_versions=PREVIOUS_SNAPSHOTS_TO_KEEP):
+    """
+    Writes the index and its (doc_id, authUid, profile, update time)
+    students, ordered as the index's row_ids count them, as a new snapshot
+    version and makes it current. Returns the path of the new version.
+    """
+    name, staging = new_version(root)
+
+    arrays, uid_table, settings = index_arrays(index)
+    for array_name, array in arrays.items():
+        np.save(os.path.join(staging, f'{array_name}.npy'), array)
+
+    uid_codes = {auth_uid: code for code, auth_uid in enumerate(uid_table)}
+    doc_ids = [doc_id for doc_id, _, _, _ in students]
+    student_uid_codes = [uid_codes[auth_uid] for _, auth_uid, _, _ in students]
+    profiles = [profile for _, _, profile, _ in students]
+    updated_at = [student_updated_at for _, _, _, student_updated_at in students]
+    with open(os.path.join(staging, 'students.json'), 'w') as f:
+        # default=str keeps unexpected field types (e.g. timestamps) from failing the write
+        json.dump({'doc_ids': doc_ids, 'uid_table': uid_table, 'uid_codes': student_uid_codes,
+                   'profiles': profiles, 'updated_at': updated_at}, f, default=str)
+
+    header = {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_FORMAT_VERSION,
+        'arrays': sorted(arrays),
+        'settings': settings,
+        'rows': len(index),
+        'students': len(doc_ids),
+        'high_water_mark': high_water_mark.isoformat() if high_water_mark else None,
+        'created_at': datetime.now().isoformat(),
+    }
+    # The header is written last; a directory without it is never valid
+    with open(os.path.join(staging, 'header.json'), 'w') as f:
+        json.dump(header, f)
+
+    return make_current(root, name, staging, previous_versions)
+
+
+def new_version(root):
+    """Creates a staging directory for a new version; returns (name, staging path)."""
+    os.makedirs(root, exist_ok=True)
+    name = f"v{int(time.time() * 1000)}-{os.getpid()}"
+    staging = os.path.join(root, f".{name}.tmp")
+    os.makedirs(staging)
+    return name, staging
+
+
+def make_current(root, name, staging, previous_versions=PREVIOUS_SNAPSHOTS_TO_KEEP):
+    """
+    Moves a fully written staging directory into place, points CURRENT at
+    it and removes all but `previous_versions` older versions. Returns the
+    path of the new version.
+    """
+    final = os.path.join(root, name)
+    os.rename(staging, final)
+    pointer = os.path.join(root, f".CURRENT.{os.getpid()}.tmp")
+    with open(pointer, 'w') as f:
+        f.write(name)
+    os.replace(pointer, os.path.join(root, 'CURRENT'))
+
+    _remove_old_versions(root, name, previous_versions)
+    return final
+
+
+def _remove_old_versions(root, current, previous_versions):
+    versions = sorted(entry for entry in os.listdir(root) if entry.startswith('v') and entry != current)
+    for entry in versions[:max(0, len(versions) - previous_versions)]:
+        shutil.rmtree(os.path.join(root, entry), ignore_errors=True)
+
+
+def current_snapshot_path(root):
+    """Returns the path of the current snapshot version, or None."""
+    try:
+        with open(os.path.join(root, 'CURRENT')) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(root, name) if name else None
+
+
+def load_snapshot(root):
+    """
+    Memory-maps the current snapshot. Returns None if there is no snapshot
+    or it was written in an unsupported format version.
+    """
+    path = current_snapshot_path(root)
+    if not path:
+        return None
+
+    with open(os.path.join(path, 'header.json')) as f:
+        header = json.load(f)
+    if header.get('format') != SNAPSHOT_FORMAT or header.get('version') != SNAPSHOT_FORMAT_VERSION:
+        logger.warning("Ignoring embeddings snapshot %s with unsupported format %s v%s", path, header.get('format'), header.get('version'))
+        return None
+
+    with open(os.path.join(path, 'students.json')) as f:
+        students = json.load(f)
+
+    # An empty roster cannot be memory-mapped (zero-length mapping)
+    mmap_mode = 'r' if header.get('rows') else None
+    arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) for name in header['arrays']}
+    index = restore_index(arrays, students['uid_table'], header['settings'])
+    return EmbeddingsSnapshot(
+        path, header, index,
+        students['doc_ids'],
+        np.array(students['uid_codes'], dtype=np.int32),
+        students['profiles'],
+        students['updated_at'],
+    )
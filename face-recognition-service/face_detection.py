@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+# Rough per-frame latency (seconds) of each detector on a Cloud Run vCPU.
+# They only seed the ordering until real measurements have accumulated.
+DEFAULT_LATENCY_PRIORS = {
+    'opencv': 0.15,
+    'ssd': 0.3,
+    'mtcnn': 1.0,
+    'retinaface': 3.0,
+}
+# How many observations the priors are worth
+PRIOR_WEIGHT = 5
+# A backend is skipped once its success rate stays below this...
+SKIP_SUCCESS_RATE = 0.05
+# ...after at least this many attempts...
+SKIP_MIN_ATTEMPTS = 20
+# ...except on every Nth request, so a skipped backend can recover
+EXPLORE_EVERY = 50
+# Smoothing factor of the exponentially weighted latency average
+LATENCY_EWMA_ALPHA = 0.2
+
+
+class BackendStats:
+    """Success counters and latency averages for one detector backend."""
+
+    def __init__(self, name):
+        self.name = name
+        self.attempts = 0
+        self.successes = 0
+        self.total_latency = 0.0
+        self.ewma_latency = None
+
+    def record(self, succeeded, latency):
+        self.attempts += 1
+        if succeeded:
+            self.successes += 1
+        self.total_latency += latency
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency += LATENCY_EWMA_ALPHA * (latency - self.ewma_latency)
+
+    @property
+    def success_rate(self):
+        """Success rate smoothed towards 50% while there is little data."""
+        return (self.successes + PRIOR_WEIGHT * 0.5) / (self.attempts + PRIOR_WEIGHT)
+
+    @property
+    def expected_latency(self):
+        """Latency estimate blending the prior with the recent average."""
+        prior = DEFAULT_LATENCY_PRIORS.get(self.name, 1.0)
+        if self.ewma_latency is None:
+            return prior
+        weight = min(self.attempts, SKIP_MIN_ATTEMPTS)
+        return (prior * PRIOR_WEIGHT + self.ewma_latency * weight) / (PRIOR_WEIGHT + weight)
+
+    def as_dict(self):
+        return {
+            'attempts': self.attempts,
+            'successes': self.successes,
+            'successRate': round(self.successes / self.attempts, 4) if self.attempts else None,
+            'avgLatencyMs': round(1000 * self.total_latency / self.attempts, 1) if self.attempts else None,
+            'recentLatencyMs': round(1000 * self.ewma_latency, 1) if self.ewma_latency is not None else None,
+        }
+
+
+class DetectorCascade:
+    """
+    Tries face detector backends in order of expected cost per successful
+    detection (latency / success rate), learned from the frames it has seen.
+
+    Backends that practically never find a face are skipped, a backend is
+    only started if its expected latency still fits in the per-request time
+    budget, and the last resort is `fallback_backend` without enforced
+    detection, mirroring the original behaviour.
+
+    `backend_lock(backend)`, if given, returns the lock that serializes a
+    backend. Each attempt takes it before its clock starts, so time spent
+    queueing behind other requests does not count as detector latency.
+    """
+
+    def __init__(self, backends, time_budget, fallback_backend='opencv', backend_lock=None):
+        self.backends = list(backends)
+        self.time_budget = time_budget
+        self.fallback_backend = fallback_backend
+        self.backend_lock = backend_lock
+        self.stats = {name: BackendStats(name) for name in self.backends}
+        self.fallback_stats = BackendStats(fallback_backend) if fallback_backend else None
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _ranked(self):
+        """Backends ordered by expected seconds per successful detection."""
+        return sorted(
+            self.backends,
+            key=lambda name: self.stats[name].expected_latency / self.stats[name].success_rate,
+        )
+
+    def plan(self):
+        """Returns the backends to try for the next request, cheapest first."""
+        with self._lock:
+            self.requests += 1
+            explore = self.requests % EXPLORE_EVERY == 0
+            planned = []
+            for name in self._ranked():
+                stats = self.stats[name]
+                if (not explore and stats.attempts >= SKIP_MIN_ATTEMPTS
+                        and stats.successes / stats.attempts < SKIP_SUCCESS_RATE):
+                    continue
+                planned.append(name)
+            return planned
+
+    def _locked(self, backend):
+        return self.backend_lock(backend) if self.backend_lock else nullcontext()
+
+    def _record(self, stats, succeeded, latency):
+        with self._lock:
+            stats.record(succeeded, latency)
+
+    def detect(self, detect_fn):
+        """
+        Runs `detect_fn(backend, enforce_detection)` through the cascade.
+
+        Returns (result, backend, attempts) where `result` is the first
+        successful result (None if every backend failed or the budget ran
+        out), `backend` is the backend that produced it, and `attempts` is a
+        list of (backend, succeeded, seconds) tuples for logging.
+        """
+        started = time.perf_counter()
+        attempts = []
+
+        def remaining():
+            return self.time_budget - (time.perf_counter() - started)
+
+        for backend in self.plan():
+            stats = self.stats[backend]
+            # Always try at least one backend; after that, only start the
+            # ones that are expected to finish within the budget
+            if attempts and stats.expected_latency > remaining():
+                logger.debug("Skipping %s - expected %.2fs exceeds remaining budget %.2fs", backend, stats.expected_latency, remaining())
+                continue
+
+            with self._locked(backend):
+                attempt_started = time.perf_counter()
+                try:
+                    result = detect_fn(backend, True)
+                except Exception as detection_error:
+                    detection_failure = detection_error
+                else:
+                    detection_failure = None
+                elapsed = time.perf_counter() - attempt_started
+            if detection_failure is not None:
+                self._record(stats, False, elapsed)
+                attempts.append((backend, False, elapsed))
+                logger.debug("Face detection failed with %s in %.2fs: %s", backend, elapsed, detection_failure)
+                continue
+
+            self._record(stats, True, elapsed)
+            attempts.append((backend, True, elapsed))
+            return result, backend, attempts
+
+        # If all detectors with enforcement failed, try without enforcement using fastest detector
+        fallback = self.fallback_stats
+        if fallback and (not attempts or fallback.expected_latency <= remaining()):
+            with self._locked(fallback.name):
+                attempt_started = time.perf_counter()
+                try:
+                    result = detect_fn(fallback.name, False)
+                except Exception as fallback_error:
+                    detection_failure = fallback_error
+                else:
+                    detection_failure = None
+                elapsed = time.perf_counter() - attempt_started
+            if detection_failure is None:
+                self._record(fallback, True, elapsed)
+                attempts.append((f"{fallback.name}-unenforced", True, elapsed))
+                return result, f"{fallback.name}-unenforced", attempts
+            self._record(fallback, False, elapsed)
+            attempts.append((f"{fallback.name}-unenforced", False, elapsed))
+            logger.debug("All face detection methods failed: %s", detection_failure)
+
+        return None, None, attempts
+
+    def stats_snapshot(self):
+        """Per-backend statistics and the current try order, for reporting."""
+        with self._lock:
+            backends = {name: stats.as_dict() for name, stats in self.stats.items()}
+            if self.fallback_stats:
+                backends[f"{self.fallback_stats.name}-unenforced"] = self.fallback_stats.as_dict()
+            order = self._ranked()
+        return {'timeBudgetSeconds': self.time_budget, 'order': order, 'backends': backends}
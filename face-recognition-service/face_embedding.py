@@ -0,0 +1,142 @@
+import logging
+import threading
+
+import cv2
+import numpy as np
+from deepface import DeepFace
+from deepface.commons import folder_utils
+from deepface.modules import detection
+
+logger = logging.getLogger(__name__)
+
+# SFace works on aligned 112x112 face crops
+SFACE_INPUT_SIZE = (112, 112)
+# Weights file downloaded by deepface when the SFace model is first built
+SFACE_WEIGHTS = "/.deepface/weights/face_recognition_sface_2021dec.onnx"
+
+# deepface caches one detector object per backend for the whole process (an
+# OpenCV CascadeClassifier for opencv, a cv2.dnn.Net for ssd, ...), and none
+# of them may be used by two threads at once
+_detector_locks = {}
+_detector_locks_guard = threading.Lock()
+
+
+def detector_lock(backend):
+    """
+    The lock serializing one detector backend. Reentrant, so a caller can
+    hold it around extract_faces (e.g. to time only the detection itself).
+    """
+    with _detector_locks_guard:
+        return _detector_locks.setdefault(backend, threading.RLock())
+
+
+def extract_faces(img_array, detector_backend='opencv', enforce_detection=False):
+    """
+    Detects and aligns faces exactly like DeepFace.represent does for SFace.
+    Returns deepface's face objects: the crop in 'face' (a (1, 112, 112, 3)
+    float array in [0, 1]), its 'facial_area' and the detector 'confidence'.
+    Calls for the same backend run one at a time; other backends and the
+    rest of the request keep running in parallel.
+    """
+    with detector_lock(detector_backend):
+        return detection.extract_faces(
+            img_path=img_array,
+            target_size=SFACE_INPUT_SIZE,
+            detector_backend=detector_backend,
+            grayscale=False,
+            enforce_detection=enforce_detection,
+            align=True,
+        )
+
+
+def extract_face(img_array, detector_backend='opencv', enforce_detection=False):
+    """Like extract_faces, but returns only the aligned crops."""
+    return [face_obj['face'] for face_obj in extract_faces(img_array, detector_backend, enforce_detection)]
+
+
+class SFaceEmbedder:
+    """
+    Computes SFace embeddings for many aligned faces per forward pass.
+
+    deepface's SFace client runs OpenCV's FaceRecognizerSF one face at a
+    time. This loads the same ONNX weights into an OpenCV DNN network and
+    feeds it a whole batch, using the preprocessing FaceRecognizerSF applies
+    (uint8 pixels, channel swap, no scaling). The first call with two
+    distinct faces is checked against the single-face path, so a network
+    that mixes up rows across the batch is caught; until then faces are
+    embedded one at a time. If the network does not accept batches, the
+    results differ, or a later batched pass fails, the embedder permanently
+    falls back to one face per forward pass, so results always match
+    DeepFace.represent.
+    """
+
+    def __init__(self, max_batch_size=32):
+        self.max_batch_size = max_batch_size
+        self.batching = None  # None until verified on two distinct faces, then True/False
+        self._model = None
+        self._net = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._model is None:
+            self._model = DeepFace.build_model('SFace')
+            try:
+                weights = folder_utils.get_deepface_home() + SFACE_WEIGHTS
+                self._net = cv2.dnn.readNetFromONNX(weights)
+            except Exception as e:
+                logger.warning("Batched SFace network unavailable, embedding faces one at a time: %s", e)
+                self.batching = False
+
+    @staticmethod
+    def _to_pixels(face):
+        # Revert deepface's [0, 1] scaling, as SFaceClient.find_embeddings does
+        return (face[0] * 255).astype(np.uint8)
+
+    def _embed_one(self, face):
+        return self._model.find_embeddings(face)
+
+    def _embed_batch(self, faces):
+        blob = cv2.dnn.blobFromImages(
+            [self._to_pixels(face) for face in faces], 1.0, SFACE_INPUT_SIZE, (0, 0, 0), swapRB=True, crop=False
+        )
+        self._net.setInput(blob)
+        output = self._net.forward()
+        return output.reshape(len(faces), -1)
+
+    def _verify_batching(self, faces):
+        """
+        Compares a batched pass over the first two faces with the single-face
+        path and sets `batching`. Leaves it None for fewer than two faces or
+        identical ones, which cannot reveal rows mixed up across the batch.
+        """
+        if len(faces) < 2 or np.array_equal(faces[0], faces[1]):
+            return
+        try:
+            batch = self._embed_batch(faces[:2])
+            reference = np.array([self._embed_one(face) for face in faces[:2]])
+            self.batching = batch.shape == reference.shape and np.allclose(batch, reference, atol=1e-4)
+        except Exception as e:
+            logger.warning("Batched SFace forward pass failed, embedding faces one at a time: %s", e)
+            self.batching = False
+        logger.info("Batched SFace forward pass %s.", 'enabled' if self.batching else 'disabled')
+
+    def embed(self, faces):
+        """Returns one embedding (list of floats) per aligned face, in order."""
+        if not faces:
+            return []
+        with self._lock:
+            self._load()
+            if self.batching is None:
+                self._verify_batching(faces)
+
+            if self.batching:
+                try:
+                    embeddings = []
+                    for start in range(0, len(faces), self.max_batch_size):
+                        embeddings.extend(self._embed_batch(faces[start:start + self.max_batch_size]).tolist())
+                    return embeddings
+                except Exception as e:
+                    logger.warning("Batched SFace forward pass failed, embedding faces one at a time from now on: %s", e)
+                    self.batching = False
+
+            return [self._embed_one(face) for face in faces]
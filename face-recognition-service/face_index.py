@@ -0,0 +1,451 @@
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# --- Index Configuration ---
+# 'exact' scans every enrolled embedding, 'ivf' only scans the clusters
+# closest to the live embedding. Small rosters always use the exact index.
+INDEX_MODES = ('exact', 'ivf')
+# How the distances of a student's embeddings are combined into one score
+AGGREGATIONS = ('min', 'mean')
+# Below this many embeddings the exact scan is already fast enough
+IVF_MIN_ROWS = 5000
+# Number of k-means training iterations for the IVF coarse quantizer
+IVF_TRAIN_ITERATIONS = 10
+# Training uses at most this many points per cluster
+IVF_TRAIN_POINTS_PER_LIST = 256
+# Upper bound on the temporary float32 memory of IVF training and cluster
+# assignment. The row-to-centroid score block has one column per list, and
+# nlist grows with the roster, so blocks are sized from nlist; the training
+# sample is capped at the same size.
+IVF_WORK_BYTES = 64 * 1024 * 1024
+# How the enrolled rows are held in memory: 'float32' as computed, 'float16'
+# at half the size, 'int8' at a quarter plus one float32 scale per row. numpy
+# widens int8 much faster than float16, so int8 is also the cheaper one to scan.
+STORAGE_DTYPES = ('float32', 'float16', 'int8')
+# Rows widened to float32 at a time when scoring compact storage
+SCORE_BLOCK_SIZE = 16384
+
+
+def normalize_embeddings(vectors):
+    """
+    Converts one embedding or a list of embeddings into float32 rows of unit
+    length. Zero vectors are left as zeros instead of producing NaNs.
+    """
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k(distances, k):
+    """Returns the indices of the k smallest distances, closest first."""
+    k = min(k, len(distances))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    closest = np.argpartition(distances, k - 1)[:k]
+    return closest[np.argsort(distances[closest], kind='stable')]
+
+
+def closest_students(distances, uid_codes, k, aggregation, max_rows_per_student):
+    """
+    Collapses per-embedding distances into per-student distances and returns
+    the k closest students as (uid code, distance) pairs, closest first.
+
+    `uid_codes` maps each distance to its student's position in the uid
+    table. With 'min' aggregation only the k * max_rows_per_student closest
+    rows can contain the k closest students, so the rest are never grouped.
+    """
+    if aggregation == 'mean':
+        student_count = int(uid_codes.max()) + 1 if len(uid_codes) else 0
+        totals = np.bincount(uid_codes, weights=distances, minlength=student_count)
+        counts = np.bincount(uid_codes, minlength=student_count)
+        seen = np.flatnonzero(counts)
+        per_student = totals[seen] / counts[seen]
+        closest = top_k(per_student, k)
+        return [(int(seen[i]), float(per_student[i])) for i in closest]
+
+    matches = []
+    for row in top_k(distances, k * max_rows_per_student):
+        code = int(uid_codes[row])
+        if all(code != seen_code for seen_code, _ in matches):
+            matches.append((code, float(distances[row])))
+            if len(matches) == k:
+                break
+    return matches
+
+
+def _row_blocks(matrix, order=None):
+    """Yields (start, rows) SCORE_BLOCK_SIZE rows at a time, taken in `order` if given."""
+    for start in range(0, len(matrix), SCORE_BLOCK_SIZE):
+        if order is None:
+            yield start, matrix[start:start + SCORE_BLOCK_SIZE]
+        else:
+            yield start, matrix[order[start:start + SCORE_BLOCK_SIZE]]
+
+
+class EmbeddingStore:
+    """
+    Contiguous matrix of normalized embeddings in one of STORAGE_DTYPES.
+
+    int8 rows are quantized symmetrically with their own scale (largest
+    absolute component / 127), so a row's dot product with a query is the
+    int8 dot product times the row's scale. Compact rows are widened to
+    float32 SCORE_BLOCK_SIZE rows at a time while scoring, which keeps the
+    temporary memory of a full scan bounded. Given an `order`, the rows are
+    gathered into the store in that order block by block, so reordering
+    never holds a second full-precision copy of the roster.
+    """
+
+    def __init__(self, matrix, dtype='float32', scales=None, order=None):
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError(f"Unknown embedding storage '{dtype}'. Expected one of {STORAGE_DTYPES}.")
+        self.dtype = dtype
+        self.scales = None
+        if dtype == 'int8' and scales is not None:
+            # Already quantized (e.g. mapped from a published index)
+            self.rows, self.scales = np.asarray(matrix, dtype=np.int8), np.asarray(scales, dtype=np.float32)
+        elif dtype == 'int8':
+            # Quantized block by block, so building never holds a float copy of the roster
+            self.rows = np.empty(np.shape(matrix), dtype=np.int8)
+            self.scales = np.empty(len(matrix), dtype=np.float32)
+            for start, block in _row_blocks(matrix, order):
+                block = np.asarray(block, dtype=np.float32)
+                scales = np.abs(block).max(axis=1) / 127.0
+                scales[scales == 0] = 1.0
+                self.rows[start:start + len(block)] = np.rint(block / scales[:, None])
+                self.scales[start:start + len(block)] = scales
+        elif order is not None or not isinstance(matrix, np.ndarray):
+            # Reordered, or read from a RowSource
+            self.rows = np.empty(np.shape(matrix), dtype=dtype)
+            for start, block in _row_blocks(matrix, order):
+                self.rows[start:start + len(block)] = block
+        else:
+            # Input already in this dtype (e.g. a memory-mapped snapshot) is used without a copy
+            self.rows = np.asarray(matrix, dtype=dtype)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def scores(self, query, start=0, stop=None):
+        """
+        Dot products of the query with rows [start, stop), as float32. An
+        (m, d) matrix of queries gives one column of scores per query.
+        """
+        stop = len(self.rows) if stop is None else min(stop, len(self.rows))
+        if self.dtype == 'float32':
+            return self.rows[start:stop] @ query.T
+        scores = np.empty((max(0, stop - start),) + query.shape[:-1], dtype=np.float32)
+        for block_start in range(start, stop, SCORE_BLOCK_SIZE):
+            block_stop = min(block_start + SCORE_BLOCK_SIZE, stop)
+            scores[block_start - start:block_stop - start] = self.rows[block_start:block_stop].astype(np.float32) @ query.T
+        if self.scales is not None:
+            scores *= self.scales[start:stop].reshape((-1,) + (1,) * (query.ndim - 1))
+        return scores
+
+    def take(self, positions, dtype=np.float32):
+        """
+        Rows at `positions` as a new `dtype` matrix, int8 rows scaled back to
+        unit length. Widened SCORE_BLOCK_SIZE rows at a time, like scores().
+        """
+        taken = np.empty((len(positions), self.rows.shape[1]), dtype=dtype)
+        for start in range(0, len(positions), SCORE_BLOCK_SIZE):
+            block = positions[start:start + SCORE_BLOCK_SIZE]
+            rows = self.rows[block].astype(np.float32)
+            if self.scales is not None:
+                rows *= self.scales[block][:, None]
+            taken[start:start + len(block)] = rows
+        return taken
+
+    def distances(self, query, start=0, stop=None):
+        """Cosine distances of the query (or queries) to rows [start, stop)."""
+        return 1.0 - self.scores(query, start, stop)
+
+
+class RowSource:
+    """
+    Read-only float32 matrix made of rows picked from EmbeddingStores (or
+    float arrays), one after the other. Rows are only widened as slices of
+    it are read, so an index can be built from the rows of the index it
+    replaces (plus a few new ones) without a full-precision copy of the
+    roster. Re-quantizing an int8 row that was scaled back gives the same row.
+    """
+
+    def __init__(self, parts, dimension):
+        # (store or array, positions of its rows to use)
+        self.parts = [(source, np.asarray(positions, dtype=np.int64)) for source, positions in parts]
+        self.offsets = np.cumsum([0] + [len(positions) for _, positions in self.parts])
+        self.shape = (int(self.offsets[-1]), dimension)
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        positions = np.arange(*key.indices(len(self))) if isinstance(key, slice) else np.asarray(key)
+        rows = np.empty((len(positions), self.shape[1]), dtype=np.float32)
+        part_ids = np.searchsorted(self.offsets, positions, side='right') - 1
+        for part_id in np.unique(part_ids):
+            selected = np.flatnonzero(part_ids == part_id)
+            source, source_positions = self.parts[part_id]
+            picked = source_positions[positions[selected] - self.offsets[part_id]]
+            rows[selected] = source.take(picked) if isinstance(source, EmbeddingStore) else source[picked]
+        return rows
+
+
+class ExactIndex:
+    """
+    Brute-force cosine search: one matrix-vector product over every
+    enrolled embedding, followed by per-student aggregation.
+    """
+
+    mode = 'exact'
+
+    def __init__(self, matrix, uids, aggregation='min', uid_table=None, storage='float32', row_ids=None):
+        self.aggregation = aggregation
+        # Optional caller ids of the rows (e.g. the snapshot's student positions), kept in search order
+        self.row_ids = None if row_ids is None else np.asarray(row_ids, dtype=np.int32)
+        if uid_table is not None:
+            # The authUids are already interned: `uids` holds codes into the table
+            self.uid_table, self.uid_codes = uid_table, np.asarray(uids, dtype=np.int32)
+        else:
+            # Intern the authUids so aggregation works on small integer codes
+            self.uid_table, self.uid_codes = np.unique(np.asarray(uids, dtype=object), return_inverse=True)
+            self.uid_codes = self.uid_codes.astype(np.int32)
+        counts = np.bincount(self.uid_codes) if len(self.uid_codes) else np.zeros(1, dtype=np.int64)
+        self.max_rows_per_student = int(counts.max())
+        # The quality check compares against the first few enrolled rows
+        self.sample_rows = np.array(matrix[:8], dtype=np.float32)
+        self.rows = EmbeddingStore(matrix, storage, order=self._row_order(matrix))
+
+    def _row_order(self, matrix):
+        """
+        Returns the search order of the rows (None keeps them as given) and
+        reorders uid_codes and row_ids to match.
+        """
+        return None
+
+    def __len__(self):
+        return len(self.uid_codes)
+
+    @property
+    def student_count(self):
+        return len(self.uid_table)
+
+    def sample_distances(self, query, sample_size):
+        """
+        Distances from the query to the first `sample_size` enrolled rows;
+        one column per query for an (m, d) matrix of queries.
+        """
+        if sample_size > len(self.sample_rows):
+            return self.rows.distances(query, 0, sample_size)
+        return 1.0 - self.sample_rows[:sample_size] @ query.T
+
+    def _candidate_distances(self, query):
+        return self.rows.distances(query), self.uid_codes
+
+    def search(self, query, k):
+        """
+        Finds the k closest students to a normalized query embedding.
+
+        Returns a list of (authUid, distance) pairs ordered from closest to
+        farthest, and the number of embeddings that were scanned.
+        """
+        distances, codes = self._candidate_distances(query)
+        return self._matches(distances, codes, k), len(distances)
+
+    def search_batch(self, queries, k):
+        """
+        Searches an (m, d) matrix of normalized queries (e.g. every face in a
+        frame) with one matrix product over the roster. Returns one
+        (matches, scanned) pair per query, as search() does.
+        """
+        distances = np.ascontiguousarray(self.rows.distances(queries).T)
+        return [(self._matches(query_distances, self.uid_codes, k), len(self.uid_codes)) for query_distances in distances]
+
+    def _matches(self, distances, codes, k):
+        closest = closest_students(distances, codes, k, self.aggregation, self.max_rows_per_student)
+        return [(self.uid_table[code], distance) for code, distance in closest]
+
+
+class IVFIndex(ExactIndex):
+    """
+    Inverted-file index: embeddings are grouped around k-means centroids and
+    a search only scans the `nprobe` groups whose centroids are closest to
+    the query. Rows are stored grouped by cluster, so every probed cluster
+    is a contiguous slice of the matrix and needs no gather copy.
+    """
+
+    mode = 'ivf'
+
+    def __init__(self, matrix, uids, aggregation='min', nlist=None, nprobe=8, centroids=None, seed=0,
+                 uid_table=None, storage='float32', row_ids=None):
+        rows = len(matrix)
+        if centroids is None:
+            if nlist is None:
+                nlist = max(1, int(4 * np.sqrt(rows)))
+            nlist = min(nlist, rows)
+            centroids = train_centroids(matrix, nlist, seed=seed)
+        self.centroids = centroids
+        self.nprobe = min(nprobe, len(centroids))
+        super().__init__(matrix, uids, aggregation, uid_table=uid_table, storage=storage, row_ids=row_ids)
+
+    def _row_order(self, matrix):
+        assignments = assign_to_centroids(matrix, self.centroids)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=len(self.centroids))
+        self.list_offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.uid_codes = self.uid_codes[order]
+        if self.row_ids is not None:
+            self.row_ids = self.row_ids[order]
+        return order
+
+    def search_batch(self, queries, k):
+        # Every query probes its own clusters, so there is no shared product
+        return [self.search(query, k) for query in queries]
+
+    def _candidate_distances(self, query):
+        centroid_scores = self.centroids @ query
+        if self.nprobe < len(self.centroids):
+            probed = np.argpartition(-centroid_scores, self.nprobe - 1)[:self.nprobe]
+        else:
+            probed = np.arange(len(self.centroids))
+
+        distance_blocks = []
+        code_blocks = []
+        for list_id in probed:
+            start, end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+            if start == end:
+                continue
+            distance_blocks.append(self.rows.distances(query, start, end))
+            code_blocks.append(self.uid_codes[start:end])
+
+        if not distance_blocks:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int32)
+        return np.concatenate(distance_blocks), np.concatenate(code_blocks)
+
+
+def assign_block_size(centroids):
+    """Rows per block whose scores against every centroid fit IVF_WORK_BYTES."""
+    return max(1, IVF_WORK_BYTES // (4 * len(centroids)))
+
+
+def assign_to_centroids(matrix, centroids):
+    """Returns the index of the closest centroid for every row, in blocks."""
+    assignments = np.empty(len(matrix), dtype=np.int64)
+    block_size = assign_block_size(centroids)
+    for start in range(0, len(matrix), block_size):
+        block = np.asarray(matrix[start:start + block_size], dtype=np.float32)
+        assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(matrix, nlist, iterations=IVF_TRAIN_ITERATIONS, seed=0):
+    """
+    Spherical k-means on a sample of the (already normalized) rows.
+    Empty clusters are re-seeded with random training points.
+    """
+    rng = np.random.default_rng(seed)
+    dimension = np.shape(matrix)[1]
+    sample_size = min(len(matrix), nlist * IVF_TRAIN_POINTS_PER_LIST, max(nlist, IVF_WORK_BYTES // (4 * dimension)))
+    sample = np.asarray(matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        sums = np.zeros_like(centroids)
+        counts = np.zeros(nlist, dtype=np.int64)
+        block_size = assign_block_size(centroids)
+        for start in range(0, sample_size, block_size):
+            block = sample[start:start + block_size]
+            assignments = np.argmax(block @ centroids.T, axis=1)
+            # Sum the block's points per cluster by sorting them into contiguous runs
+            order = np.argsort(assignments, kind='stable')
+            block_counts = np.bincount(assignments, minlength=nlist)
+            non_empty = np.flatnonzero(block_counts)
+            starts = np.concatenate(([0], np.cumsum(block_counts)))[non_empty]
+            sums[non_empty] += np.add.reduceat(block[order], starts, axis=0)
+            counts += block_counts
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+        centroids = normalize_embeddings(sums)
+
+    return centroids
+
+
+def index_arrays(index):
+    """
+    Splits an index into its numpy arrays, its uid table and its settings,
+    so it can be written out and mapped again by restore_index().
+    """
+    arrays = {'rows': index.rows.rows, 'uid_codes': index.uid_codes, 'sample_rows': index.sample_rows}
+    if index.rows.scales is not None:
+        arrays['scales'] = index.rows.scales
+    if index.row_ids is not None:
+        arrays['row_ids'] = index.row_ids
+    settings = {
+        'mode': index.mode, 'aggregation': index.aggregation, 'storage': index.rows.dtype,
+        'max_rows_per_student': index.max_rows_per_student,
+    }
+    if isinstance(index, IVFIndex):
+        arrays['centroids'] = index.centroids
+        arrays['list_offsets'] = index.list_offsets
+        settings['nprobe'] = index.nprobe
+    return arrays, list(index.uid_table), settings
+
+
+def restore_index(arrays, uid_table, settings):
+    """
+    Rebuilds an index from the output of index_arrays() without copying or
+    re-arranging the arrays, which may be memory-mapped.
+    """
+    index_class = IVFIndex if settings['mode'] == IVFIndex.mode else ExactIndex
+    index = index_class.__new__(index_class)
+    index.aggregation = settings['aggregation']
+    index.uid_table = np.array(uid_table, dtype=object)
+    index.uid_codes = arrays['uid_codes']
+    index.row_ids = arrays.get('row_ids')
+    index.max_rows_per_student = settings['max_rows_per_student']
+    index.sample_rows = np.asarray(arrays['sample_rows'])
+    index.rows = EmbeddingStore(arrays['rows'], settings['storage'], scales=arrays.get('scales'))
+    if index_class is IVFIndex:
+        index.centroids = np.asarray(arrays['centroids'])
+        index.list_offsets = np.asarray(arrays['list_offsets'])
+        index.nprobe = settings['nprobe']
+    return index
+
+
+def build_index(matrix, uids, mode='exact', aggregation='min', nlist=None, nprobe=8, centroids=None, uid_table=None,
+                storage='float32', row_ids=None):
+    """
+    Builds the configured index over a normalized embedding matrix.
+    Falls back to the exact index for rosters too small to benefit from IVF.
+    Passing the centroids of a previous IVF index skips k-means training;
+    passing a uid table means `uids` already holds codes into that table.
+    `storage` is the in-memory dtype of the enrolled rows (STORAGE_DTYPES).
+    `row_ids` are carried along with the rows (see ExactIndex.row_ids).
+    `matrix` may also be a RowSource.
+    """
+    if mode not in INDEX_MODES:
+        raise ValueError(f"Unknown face index mode '{mode}'. Expected one of {INDEX_MODES}.")
+    if aggregation not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation '{aggregation}'. Expected one of {AGGREGATIONS}.")
+    if storage not in STORAGE_DTYPES:
+        raise ValueError(f"Unknown embedding storage '{storage}'. Expected one of {STORAGE_DTYPES}.")
+
+    started = time.perf_counter()
+    if mode == 'ivf' and len(matrix) >= IVF_MIN_ROWS:
+        index = IVFIndex(matrix, uids, aggregation=aggregation, nlist=nlist, nprobe=nprobe,
+                         centroids=centroids, uid_table=uid_table, storage=storage, row_ids=row_ids)
+        logger.info("Built IVF index over %d embeddings (%d lists, nprobe=%d) in %.2fs",
+                    len(index), len(index.centroids), index.nprobe, time.perf_counter() - started)
+    else:
+        index = ExactIndex(matrix, uids, aggregation=aggregation, uid_table=uid_table, storage=storage, row_ids=row_ids)
+    return index
@@ -0,0 +1,87 @@
+import base64
+import binascii
+import io
+
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+# Content types accepted as a raw image request body
+RAW_IMAGE_CONTENT_TYPES = ('image/jpeg', 'image/jpg', 'image/png', 'image/webp', 'application/octet-stream')
+
+
+class ImageRequestError(ValueError):
+    """The request carries no usable image; the message is safe to return."""
+
+
+def image_bytes_from_request(request, field='image'):
+    """
+    Returns the encoded image bytes of a request, accepting:
+
+    - a raw JPEG/PNG body (Content-Type image/* or application/octet-stream)
+    - a multipart upload with the image in `field` (or as the only file)
+    - JSON {"<field>": "<base64>"}, optionally as a data URL
+
+    Raises ImageRequestError if none of these is present.
+    """
+    content_type = (request.mimetype or '').lower()
+    if content_type in RAW_IMAGE_CONTENT_TYPES:
+        body = request.get_data(cache=False)
+        if not body:
+            raise ImageRequestError('Empty image body.')
+        return body
+
+    if request.files:
+        upload = request.files.get(field)
+        if upload is None and len(request.files) == 1:
+            upload = next(iter(request.files.values()))
+        if upload is None:
+            raise ImageRequestError(f"Missing '{field}' file in upload.")
+        return upload.read()
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or field not in data:
+        raise ImageRequestError('Missing image data in request.')
+    return decode_base64_image(data[field])
+
+
+def decode_base64_image(encoded):
+    """Decodes a base64 image string, with or without a data URL prefix."""
+    if not isinstance(encoded, str):
+        raise ImageRequestError('Image data must be a base64 string.')
+    if encoded.startswith('data:'):
+        encoded = encoded.partition(',')[2]
+    try:
+        return base64.b64decode(encoded)
+    except (binascii.Error, ValueError) as e:
+        raise ImageRequestError(f'Invalid base64 image data: {e}')
+
+
+def load_image_array(image_bytes, max_side=None):
+    """
+    Decodes an encoded image into an RGB uint8 array whose longer side is at
+    most `max_side` pixels.
+
+    JPEGs are decoded in draft mode, which lets libjpeg scale by 1/2, 1/4 or
+    1/8 while decoding, so a multi-megapixel camera frame is never expanded
+    at full resolution. The remaining reduction is a single resize, done
+    before any detector sees the frame.
+
+    Raises ImageRequestError if the bytes are not a readable image.
+    """
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        if max_side and max(img.size) > max_side:
+            scale = max_side / max(img.size)
+            if img.format == 'JPEG':
+                # draft() picks the largest DCT scale that stays >= this size
+                img.draft('RGB', (int(img.width * scale) + 1, int(img.height * scale) + 1))
+            img.thumbnail((max_side, max_side), Image.BILINEAR, reducing_gap=2.0)
+        # Truncated or corrupt image data only fails once the pixels are decoded
+        img.load()
+    except UnidentifiedImageError:
+        raise ImageRequestError('Image data is not a JPEG, PNG or other supported image.')
+    except OSError as e:
+        raise ImageRequestError(f'Could not decode image: {e}')
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return np.array(img)
@@ -0,0 +1,145 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerBusy(Exception):
+    """The inference queue is full; the request should be retried later."""
+
+
+class InferenceScheduler:
+    """
+    Runs SFace embeddings for concurrent requests on one inference thread,
+    grouping the faces that arrive within `max_wait` seconds of each other
+    into a single batched forward pass.
+
+    Request threads submit aligned faces and block on a Future. The
+    inference thread takes the oldest face, then keeps collecting while
+    other requests are still in flight (see `in_flight`), until the batch
+    holds `max_batch_size` faces or `max_wait` has passed, and hands the
+    whole batch to `embedder.embed`. A lone request never waits, while
+    concurrent kiosks share one forward pass instead of queueing for the
+    model one after another.
+
+    The queue holds at most `max_queue` faces. A submit that does not fit
+    raises SchedulerBusy straight away, so an overloaded worker answers 503
+    instead of piling up decoded frames in memory.
+    """
+
+    def __init__(self, embedder, max_batch_size=8, max_wait=0.005, max_queue=32, timeout=30.0):
+        self.embedder = embedder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._active = 0
+        self._active_lock = threading.Lock()
+        # Counters for /ready and /metrics
+        self.batches = 0
+        self.faces = 0
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def depth(self):
+        """Faces waiting for the inference thread."""
+        return self._queue.qsize()
+
+    @contextmanager
+    def in_flight(self):
+        """
+        Marks a request that may submit faces soon. The inference thread only
+        holds a batch open for faces of requests that are in flight.
+        """
+        with self._active_lock:
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._active_lock:
+                self._active -= 1
+
+    def start(self):
+        """Starts the inference thread (once)."""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='inference-scheduler', daemon=True)
+                self._thread.start()
+
+    def embed(self, faces):
+        """
+        Returns one embedding per aligned face, like SFaceEmbedder.embed, but
+        computed on the inference thread together with other requests' faces.
+        Raises SchedulerBusy if the queue cannot take all of the faces.
+        """
+        if not faces:
+            return []
+        self.start()
+        futures = []
+        try:
+            for face in faces:
+                future = Future()
+                self._queue.put_nowait((face, future))
+                futures.append(future)
+        except queue.Full:
+            for future in futures:
+                future.cancel()
+            self.rejected += 1
+            raise SchedulerBusy(f"Inference queue is full ({self.max_queue} faces waiting).")
+
+        deadline = time.monotonic() + self.timeout
+        try:
+            return [future.result(timeout=max(0.0, deadline - time.monotonic())) for future in futures]
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        collect_until = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = collect_until - time.monotonic()
+            # Only wait if some other in-flight request has not submitted yet
+            if remaining <= 0 or self._active <= len(batch):
+                remaining = 0
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        # Faces whose request gave up (timeout or rejection) are dropped here
+        return [(face, future) for face, future in batch if future.set_running_or_notify_cancel()]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                embeddings = self.embedder.embed([face for face, _ in batch])
+            except Exception as e:
+                self.failed += len(batch)
+                logger.exception("Batched embedding of %d faces failed", len(batch))
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.faces += len(batch)
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+    def stats(self):
+        return {
+            'queueDepth': self.depth, 'maxQueue': self.max_queue, 'maxBatchSize': self.max_batch_size,
+            'batches': self.batches, 'faces': self.faces, 'rejected': self.rejected, 'failed': self.failed,
+            'avgBatchSize': round(self.faces / self.batches, 2) if self.batches else None,
+        }
@@ -1,20 +1,40 @@
+import logging
 import os
+import threading
 import time
 import tempfile
-import traceback
-from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS, cross_origin
-from PIL import Image
 import numpy as np
-import base64
-import io
-from datetime import datetime, timedelta, timezone, date
+from datetime import datetime, timezone
 
 from deepface import DeepFace
+from deepface.detectors import DetectorWrapper
 from google.cloud import storage
 import firebase_admin
-from firebase_admin import credentials, firestore, auth
-from deepface.modules.verification import find_cosine_distance
+from firebase_admin import credentials, firestore
+
+from attendance import PHNOM_PENH_TZ, AttendanceLedger, ClassScheduleCache
+from embeddings_cache import EnrolledFacesCache
+from face_detection import DetectorCascade
+from face_embedding import SFaceEmbedder, detector_lock, extract_face, extract_faces
+from face_index import normalize_embeddings
+from image_ingest import ImageRequestError, decode_base64_image, image_bytes_from_request, load_image_array
+from inference_scheduler import InferenceScheduler, SchedulerBusy
+from logging_config import configure_logging
+from metrics import REGISTRY, Counter, Gauge, Histogram
+from session_cache import RecentRecognitionCache
+from token_cache import VerifiedTokenCache
+
+# --- Logging ---
+# LOG_LEVEL=DEBUG adds per-request match details; LOG_FORMAT=text is easier to
+# read locally, 'json' gives Cloud Logging severities and structured fields.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+configure_logging(LOG_LEVEL, LOG_FORMAT)
+logger = logging.getLogger('face-recognition')
 
 # --- Configuration ---
 # BUCKET_NAME is no longer needed for cache refresh, but might be useful elsewhere.
@@ -31,9 +51,9 @@ try:
         'storageBucket': BUCKET_NAME
     })
     db = firestore.client()
-    print("Firebase Admin initialized successfully.")
+    logger.info("Firebase Admin initialized successfully.")
 except Exception as e:
-    print(f"Error initializing Firebase Admin: {e}")
+    logger.error("Error initializing Firebase Admin: %s", e)
     db = None
 
 storage_client = storage.Client()
@@ -50,67 +70,198 @@ CORS(app,
 # No need for @app.before_request and @app.after_request CORS handlers
 
 # --- In-memory Cache for Enrolled Faces ---
-# This will be a list of dicts: {'uid': student_uid, 'embedding': embedding_vector}
-enrolled_embeddings_list = []
-# Timestamp of the last cache refresh
-last_cache_refresh = 0
+# Full resync interval for the background refresher. Individual enrollments
+# arrive through a Firestore snapshot listener within seconds.
 CACHE_REFRESH_INTERVAL = 3600 # Refresh every hour (in seconds)
+# Delay used to coalesce bursts of enrollment changes into one index rebuild
+CACHE_REBUILD_DEBOUNCE = 0.5
+# Memory-mapped snapshot of the search-ready index, so (re)started workers
+# skip the full Firestore scan and the index build. Only useful on a volume
+# that outlives the instance (e.g. a GCS FUSE mount at /mnt/face-snapshots):
+# on Cloud Run /tmp is in-memory and per instance, so a cold start would
+# never find a snapshot there and it would use container memory. Empty (the
+# default) disables snapshots.
+EMBEDDINGS_SNAPSHOT_DIR = os.environ.get('EMBEDDINGS_SNAPSHOT_DIR', '')
+# Minimum time between snapshot writes while enrollments keep changing
+EMBEDDINGS_SNAPSHOT_INTERVAL = 300
+# With several gunicorn workers, point this at a tmpfs (e.g. /dev/shm/face-index):
+# one leader worker refreshes the roster and publishes the index there, the
+# others map it, so the roster is held and loaded once per instance. Empty
+# (the default) gives every worker its own refresher and index.
+SHARED_INDEX_DIR = os.environ.get('SHARED_INDEX_DIR', '')
+
+# --- Matching Configuration ---
+# The threshold for SFace - slightly more lenient for better recognition
+# while still maintaining security. Updated to 0.68 for better matching.
+# Updated: 2025-08-18 - Changed from 0.65 to 0.68 for better recognition accuracy
+RECOGNITION_THRESHOLD = 0.68
+# Number of closest matches reported in the comparison summary
+TOP_K_MATCHES = 3
+# The quality check averages the distance to the first few cached embeddings
+QUALITY_SAMPLE_SIZE = 5
+QUALITY_MAX_AVG_DISTANCE = 0.90
+# 'exact' scans every embedding; 'ivf' is an approximate index for large rosters
+FACE_INDEX_MODE = os.environ.get('FACE_INDEX_MODE', 'exact')
+# How multiple embeddings of one student are combined: 'min' or 'mean' distance
+FACE_INDEX_AGGREGATION = os.environ.get('FACE_INDEX_AGGREGATION', 'min')
+# IVF tuning: number of clusters (default 4 * sqrt(rows)) and clusters scanned per query
+IVF_NLIST = int(os.environ['IVF_NLIST']) if os.environ.get('IVF_NLIST') else None
+IVF_NPROBE = int(os.environ.get('IVF_NPROBE', 16))
+# In-memory dtype of the enrolled rows: 'float32', 'float16' or 'int8'. int8
+# holds a roster in about a quarter of the memory and scans almost as fast;
+# benchmarks/index_recall.py --storage checks its accuracy at the threshold.
+FACE_INDEX_STORAGE = os.environ.get('FACE_INDEX_STORAGE', 'float32')
+
+
+# Search index over the pre-normalized matrix of enrolled embeddings
+# (see face_index.py), maintained by a background refresher thread.
+enrolled_faces = EnrolledFacesCache(
+    db,
+    index_options={
+        'mode': FACE_INDEX_MODE, 'aggregation': FACE_INDEX_AGGREGATION,
+        'nlist': IVF_NLIST, 'nprobe': IVF_NPROBE, 'storage': FACE_INDEX_STORAGE,
+    },
+    refresh_interval=CACHE_REFRESH_INTERVAL,
+    debounce=CACHE_REBUILD_DEBOUNCE,
+    snapshot_dir=EMBEDDINGS_SNAPSHOT_DIR or None,
+    snapshot_interval=EMBEDDINGS_SNAPSHOT_INTERVAL,
+    shared_dir=SHARED_INDEX_DIR or None,
+)
+
+
+# --- Class/Shift Schedule Cache ---
+# Shift start times are kept current by a listener on the 'classes'
+# collection; the TTL only applies when the client cannot listen.
+CLASS_SCHEDULE_TTL = int(os.environ.get('CLASS_SCHEDULE_TTL', 600))
+class_schedules = ClassScheduleCache(db, ttl=CLASS_SCHEDULE_TTL)
+
+# --- Attendance Ledger ---
+# Today's attendance is kept in memory; new records are committed to
+# Firestore in batches every ATTENDANCE_FLUSH_INTERVAL seconds (and on exit).
+ATTENDANCE_FLUSH_INTERVAL = float(os.environ.get('ATTENDANCE_FLUSH_INTERVAL', 1.0))
+ATTENDANCE_BATCH_SIZE = int(os.environ.get('ATTENDANCE_BATCH_SIZE', 200))
+attendance_ledger = AttendanceLedger(db, flush_interval=ATTENDANCE_FLUSH_INTERVAL, batch_size=ATTENDANCE_BATCH_SIZE)
 
 
 def refresh_enrolled_faces_cache():
     """
     Loads pre-computed facial embeddings directly from the 'facialEmbeddings'
-    field in each student's Firestore document.
+    field in each student's Firestore document and swaps in a new index.
     """
-    global enrolled_embeddings_list, last_cache_refresh
-    print("\n" + "="*50)
-    print("🔄 REFRESHING FACE EMBEDDINGS CACHE")
-    print("="*50)
-
-    if not db:
-        print("❌ Firestore client not available. Skipping cache refresh.")
-        return
-
-    try:
-        temp_embeddings_list = []
-        # Query for all students that have the 'facialEmbeddings' field.
-        students_ref = db.collection('students').where("facialEmbeddings", "!=", [])
-        students = students_ref.stream()
-
-        for student in students:
-            student_uid = student.id
-            student_data = student.to_dict()
-            stored_embeddings = student_data.get("facialEmbeddings", [])
-            auth_uid = student_data.get("authUid") # <-- Get the authUid
-
-            # We must have an authUid to perform the final lookup
-            if not auth_uid:
-                print(f"DEBUG: Skipping student {student_uid} because they are missing an authUid.")
-                continue
-            
-            # A student can have multiple embeddings. We need to cache all of them.
-            for embedding_obj in stored_embeddings:
-                if isinstance(embedding_obj, dict) and 'embedding' in embedding_obj:
-                    embedding_vector = embedding_obj['embedding']
-                    # The 'identity' key is what DeepFace.find returns, so we use 'uid' for that.
-                    temp_embeddings_list.append({
-                        "uid": auth_uid, # <-- Store the auth_uid in the cache
-                        "embedding": embedding_vector
-                    })
-                    print(f"Cached embedding for student doc {student_uid} with authUid {auth_uid}")
-
-        # DeepFace.find requires a specific format for its database path.
-        # It expects a list of lists, where each inner list is [identity_path, embedding_vector].
-        enrolled_embeddings_list = temp_embeddings_list
-        last_cache_refresh = time.time()
-        
-        print(f"✅ Cache refresh completed!")
-        print(f"📊 Total students cached: {len(enrolled_embeddings_list)}")
-        print("="*50 + "\n")
-
-    except Exception as e:
-        print(f"❌ Error during cache refresh: {e}")
-        traceback.print_exc()
+    enrolled_faces.reload()
+
+# --- Face Detection ---
+# Detector backends the cascade may use, fastest first by default
+DETECTION_BACKENDS = os.environ.get('DETECTION_BACKENDS', 'opencv,ssd,mtcnn,retinaface').split(',')
+# Upper bound (seconds) on the time a single request spends on detection
+DETECTION_TIME_BUDGET = float(os.environ.get('DETECTION_TIME_BUDGET', 4.0))
+
+# Frames are downscaled to at most this many pixels on the longer side while
+# decoding, before any detector sees them; set to 0 to keep full resolution
+IMAGE_MAX_SIDE = int(os.environ.get('IMAGE_MAX_SIDE', 960))
+
+detector_cascade = DetectorCascade(DETECTION_BACKENDS, DETECTION_TIME_BUDGET, fallback_backend='opencv',
+                                   backend_lock=detector_lock)
+
+# --- Batch Embedding ---
+# Upper bound on images per /generate-embeddings request
+EMBEDDING_BATCH_MAX_IMAGES = int(os.environ.get('EMBEDDING_BATCH_MAX_IMAGES', 200))
+# Threads used to decode images in parallel; detection on the shared opencv
+# detector runs one image at a time (see face_embedding.extract_faces)
+EMBEDDING_BATCH_WORKERS = int(os.environ.get('EMBEDDING_BATCH_WORKERS', min(4, os.cpu_count() or 1)))
+
+embedding_batch_pool = ThreadPoolExecutor(max_workers=EMBEDDING_BATCH_WORKERS, thread_name_prefix='embedding-batch')
+sface_embedder = SFaceEmbedder()
+
+# --- Inference Scheduler ---
+# /recognize embeddings run on one inference thread that batches the faces
+# of concurrent requests arriving within INFERENCE_MAX_WAIT_MS of each other.
+# When INFERENCE_QUEUE_DEPTH faces are already waiting, requests get a 503.
+INFERENCE_MAX_BATCH_SIZE = int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 8))
+INFERENCE_MAX_WAIT_MS = float(os.environ.get('INFERENCE_MAX_WAIT_MS', 5))
+INFERENCE_QUEUE_DEPTH = int(os.environ.get('INFERENCE_QUEUE_DEPTH', 32))
+INFERENCE_TIMEOUT = float(os.environ.get('INFERENCE_TIMEOUT', 30))
+inference_scheduler = InferenceScheduler(
+    sface_embedder,
+    max_batch_size=INFERENCE_MAX_BATCH_SIZE,
+    max_wait=INFERENCE_MAX_WAIT_MS / 1000,
+    max_queue=INFERENCE_QUEUE_DEPTH,
+    timeout=INFERENCE_TIMEOUT,
+)
+
+# --- Group Check-in ---
+# /recognize?mode=group matches every face in the frame; at most this many
+# faces (the largest, i.e. closest to the kiosk) are recognized per frame
+GROUP_MAX_FACES = int(os.environ.get('GROUP_MAX_FACES', 10))
+
+# --- Recent Recognitions ---
+# A kiosk (X-Device-Id header, else the signed-in admin) that sends another
+# frame of a face it had recognized in the last SESSION_CACHE_TTL seconds,
+# within SESSION_CACHE_MAX_DISTANCE of it, gets the same response without a
+# roster scan or attendance check. SESSION_CACHE_TTL=0 disables the cache.
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', 10))
+SESSION_CACHE_MAX_DISTANCE = float(os.environ.get('SESSION_CACHE_MAX_DISTANCE', 0.2))
+recent_recognitions = RecentRecognitionCache(ttl=SESSION_CACHE_TTL, max_distance=SESSION_CACHE_MAX_DISTANCE)
+
+# --- ID Token Cache ---
+# Decoded admin tokens are reused until they expire instead of verifying the
+# signature on every scan. TOKEN_CHECK_REVOKED=true also rejects revoked
+# sessions, re-checking cached tokens every TOKEN_REVOCATION_RECHECK seconds.
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 256))
+TOKEN_CHECK_REVOKED = os.environ.get('TOKEN_CHECK_REVOKED', 'false').lower() == 'true'
+TOKEN_REVOCATION_RECHECK = int(os.environ.get('TOKEN_REVOCATION_RECHECK', 300))
+token_cache = VerifiedTokenCache(
+    max_entries=TOKEN_CACHE_SIZE,
+    check_revoked=TOKEN_CHECK_REVOKED,
+    revocation_recheck_interval=TOKEN_REVOCATION_RECHECK,
+)
+
+# --- Metrics ---
+# Exported in Prometheus text format at /metrics
+recognize_requests = Counter('recognize_requests', '/recognize requests by outcome.', ['outcome'])
+recognize_seconds = Histogram('recognize_request_seconds', 'End-to-end /recognize latency by outcome.', ['outcome'])
+recognize_stage_seconds = Histogram(
+    'recognize_stage_seconds',
+    '/recognize latency per stage (auth, decode, detection, embedding, session, matching, profile, attendance).',
+    ['stage'])
+detection_seconds = Histogram('face_detection_seconds', 'Face detection attempts per backend.', ['backend', 'outcome'])
+
+enrolled_embeddings = Gauge('enrolled_embeddings', 'Embeddings in the current face index.')
+enrolled_embeddings.set_function(lambda: len(enrolled_faces.index) if enrolled_faces.index is not None else None)
+enrolled_embeddings_bytes = Gauge('enrolled_embeddings_bytes', 'Memory held by the rows of the current face index.')
+enrolled_embeddings_bytes.set_function(lambda: enrolled_faces.index.rows.nbytes if enrolled_faces.index is not None else None)
+enrolled_students = Gauge('enrolled_students', 'Students in the current face index.')
+enrolled_students.set_function(lambda: enrolled_faces.index.student_count if enrolled_faces.index is not None else None)
+student_profiles = Gauge('student_profiles', 'Student profiles cached next to the face index.')
+student_profiles.set_function(lambda: len(enrolled_faces.profiles))
+embeddings_last_refresh = Gauge('embeddings_last_refresh_timestamp_seconds', 'Unix time of the last face index swap.')
+embeddings_last_refresh.set_function(lambda: enrolled_faces.last_refresh or None)
+class_schedule_classes = Gauge('class_schedule_classes', 'Classes in the shift schedule cache.')
+class_schedule_classes.set_function(lambda: len(class_schedules.schedules) if class_schedules.schedules is not None else None)
+attendance_pending_writes = Gauge('attendance_ledger_pending_writes', 'Attendance records waiting to be committed.')
+attendance_pending_writes.set_function(lambda: attendance_ledger.pending)
+attendance_records_written = Counter('attendance_records_written', 'Attendance records committed to Firestore.')
+attendance_records_written.set_function(lambda: attendance_ledger.written)
+attendance_records_failed = Counter('attendance_records_failed', 'Attendance records that could not be written before exit.')
+attendance_records_failed.set_function(lambda: attendance_ledger.failed)
+inference_queue_depth = Gauge('inference_queue_depth', 'Faces waiting for the inference thread.')
+inference_queue_depth.set_function(lambda: inference_scheduler.depth)
+inference_batches = Counter('inference_batches', 'Batched SFace forward passes run by the inference scheduler.')
+inference_batches.set_function(lambda: inference_scheduler.batches)
+inference_faces = Counter('inference_faces', 'Faces embedded by the inference scheduler.')
+inference_faces.set_function(lambda: inference_scheduler.faces)
+inference_rejected = Counter('inference_rejected', 'Requests turned away because the inference queue was full.')
+inference_rejected.set_function(lambda: inference_scheduler.rejected)
+session_cache_entries = Gauge('session_cache_entries', 'Recent recognitions kept for repeated kiosk frames.')
+session_cache_entries.set_function(lambda: recent_recognitions.stats()['entries'])
+session_cache_lookups = Counter('session_cache_lookups', 'Recent recognition cache lookups by result.', ['result'])
+session_cache_lookups.set_function(lambda: recent_recognitions.hits, result='hit')
+session_cache_lookups.set_function(lambda: recent_recognitions.misses, result='miss')
+token_cache_entries = Gauge('token_cache_entries', 'Decoded ID tokens in the token cache.')
+token_cache_entries.set_function(lambda: token_cache.stats()['size'])
+token_cache_lookups = Counter('token_cache_lookups', 'ID token cache lookups by result.', ['result'])
+token_cache_lookups.set_function(lambda: token_cache.hits, result='hit')
+token_cache_lookups.set_function(lambda: token_cache.misses, result='miss')
 
 # --- Utility Functions ---
 def verify_firebase_token(request):
@@ -120,352 +271,490 @@ def verify_firebase_token(request):
         return None
     id_token = auth_header.split('Bearer ')[1]
     try:
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_cache.verify(id_token)
         return decoded_token
     except Exception as e:
-        print(f"Token verification failed: {e}")
+        logger.warning("Token verification failed: %s", e)
         return None
 
+# --- Model Warm-up ---
+# 'blocking' warms up before the worker accepts requests, so traffic only
+# reaches warm workers (also after --max-requests recycling); 'background'
+# warms up on a thread while /ready reports 503; 'off' keeps lazy loading.
+WARMUP_MODE = os.environ.get('WARMUP_MODE', 'blocking')
+# Detector backends to preload; defaults to every backend the cascade may use
+WARMUP_BACKENDS = os.environ.get('WARMUP_BACKENDS', ','.join(DETECTION_BACKENDS)).split(',')
+
+warmup_status = {'done': False, 'seconds': {}, 'errors': {}}
+
+
+def warm_up_models():
+    """
+    Builds and caches the SFace model and every configured detector, then
+    runs a dummy inference through each one so that model construction and
+    graph tracing happen before the first real /recognize request.
+    """
+    logger.info("Warming up SFace model and detectors...")
+    started = time.perf_counter()
+    # Textured dummy frame; a flat image can short-circuit some detectors
+    dummy_image = np.random.default_rng(0).integers(0, 255, size=(224, 224, 3), dtype=np.uint8)
+
+    step_started = time.perf_counter()
+    try:
+        DeepFace.build_model('SFace')
+        # Also loads the batched SFace network and verifies it on two distinct crops
+        dummy_faces = [dummy_image[None, :112, :112, :].astype(np.float32) / 255,
+                       dummy_image[None, 112:, 112:, :].astype(np.float32) / 255]
+        sface_embedder.embed(dummy_faces)
+        warmup_status['seconds']['SFace'] = round(time.perf_counter() - step_started, 3)
+    except Exception as e:
+        warmup_status['errors']['SFace'] = str(e)
+        logger.error("Could not build SFace model: %s", e)
+
+    for backend in WARMUP_BACKENDS:
+        step_started = time.perf_counter()
+        try:
+            DetectorWrapper.build_model(backend)
+            extract_face(dummy_image, detector_backend=backend, enforce_detection=False)
+            warmup_status['seconds'][backend] = round(time.perf_counter() - step_started, 3)
+        except Exception as e:
+            warmup_status['errors'][backend] = str(e)
+            logger.error("Could not warm up detector %s: %s", backend, e)
+
+    warmup_status['done'] = True
+    logger.info("Warm-up finished in %.2fs", time.perf_counter() - started, extra={'fields': {'warmupSeconds': warmup_status['seconds']}})
+
+
+def is_ready():
+    """Ready once the models are warm and an enrolled faces index exists."""
+    models_ready = WARMUP_MODE == 'off' or (warmup_status['done'] and 'SFace' not in warmup_status['errors'])
+    return models_ready and enrolled_faces.index is not None
+
+
 # --- Populate cache on startup ---
-with app.app_context():
-    refresh_enrolled_faces_cache()
+# A snapshot on disk is memory-mapped right away; otherwise the first load
+# runs on the refresher thread and /recognize answers 503 until it is ready.
+enrolled_faces.start()
+class_schedules.start()
+attendance_ledger.start()
+inference_scheduler.start()
+
+if WARMUP_MODE == 'blocking':
+    warm_up_models()
+elif WARMUP_MODE == 'background':
+    threading.Thread(target=warm_up_models, name='model-warmup', daemon=True).start()
 
 # --- API Routes ---
+@contextmanager
+def timed_stage(timings, stage):
+    """Records the duration of a /recognize stage in `timings` and the stage histogram."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        timings[stage] = round(elapsed * 1000, 3)
+        recognize_stage_seconds.observe(elapsed, stage=stage)
+
+
 @app.route('/recognize', methods=['POST'])
 @cross_origin()
 def recognize_face():
     """
-    Receives a base64 encoded image, recognizes the face,
-    and returns student information.
+    Receives an image (raw JPEG/PNG body, multipart 'image' upload or JSON
+    {"image": base64}), recognizes the face, and returns student information.
+    With ?mode=group every face in the frame is recognized and checked in,
+    and the response lists one result per face.
     """
+    started = time.perf_counter()
+    timings = {}
+    details = {}
+    with inference_scheduler.in_flight():
+        body, status_code = _recognize_face(timings, details)
+
+    outcome = body.get('status') or ('error' if status_code >= 400 else 'ok')
+    elapsed = time.perf_counter() - started
+    recognize_requests.inc(outcome=outcome)
+    recognize_seconds.observe(elapsed, outcome=outcome)
+    logger.info("Recognition finished: %s", outcome, extra={'fields': {
+        'outcome': outcome, 'httpStatus': status_code, 'totalMs': round(elapsed * 1000, 1),
+        'stagesMs': timings, **details,
+    }})
+    return jsonify(body), status_code
+
+
+def _recognize_face(timings, details):
+    """The /recognize pipeline. Returns (response body, HTTP status)."""
+    group_mode = request.args.get('mode') == 'group'
+    if group_mode:
+        details['mode'] = 'group'
+
     # 1. Authorize the request
-    decoded_token = verify_firebase_token(request)
+    with timed_stage(timings, 'auth'):
+        decoded_token = verify_firebase_token(request)
     if not decoded_token:
-        return jsonify({'error': 'Unauthorized request. Invalid or missing token.'}), 403
-
-    # 2. Check and refresh cache if needed
-    if time.time() - last_cache_refresh > CACHE_REFRESH_INTERVAL:
-        refresh_enrolled_faces_cache()
+        return {'error': 'Unauthorized request. Invalid or missing token.'}, 403
 
-    if not enrolled_embeddings_list:
-        return jsonify({'error': 'No enrolled faces found in Firestore. Please enroll students first.'}), 500
+    # 2. Use the current index; the background refresher keeps it up to date
+    index = enrolled_faces.index
+    if index is None:
+        return {'error': 'Enrolled faces are still loading. Please try again shortly.'}, 503
 
-    # 3. Process the incoming image
-    data = request.get_json()
-    if 'image' not in data:
-        return jsonify({'error': 'Missing image data in request.'}), 400
+    if not index:
+        return {'error': 'No enrolled faces found in Firestore. Please enroll students first.'}, 500
 
     try:
-        image_data = base64.b64decode(data['image'])
-        img_array = np.array(Image.open(io.BytesIO(image_data)))
-
-        # 4. Generate embedding for the incoming face using SFace with more efficient detection
-        live_embedding_obj = None
-        # Prioritize faster detectors first, then fall back to more robust ones
-        detection_backends = ['opencv', 'ssd', 'mtcnn', 'retinaface']
-        
-        for backend in detection_backends:
-            try:
-                print(f"DEBUG: Trying face detection with {backend}...")
-                live_embedding_obj = DeepFace.represent(
-                    img_path=img_array,
-                    model_name='SFace',
-                    enforce_detection=True,
-                    detector_backend=backend
-                )
-                print(f"DEBUG: ✅ Face detection succeeded with {backend}")
-                break
-            except Exception as detection_error:
-                print(f"DEBUG: ❌ Face detection failed with {backend}: {detection_error}")
-                continue
-        
-        # If all detectors with enforcement failed, try without enforcement using fastest detector
-        if not live_embedding_obj:
-            try:
-                print("DEBUG: Trying face detection without enforcement using opencv...")
-                live_embedding_obj = DeepFace.represent(
-                    img_path=img_array,
-                    model_name='SFace',
-                    enforce_detection=False,
-                    detector_backend='opencv'
-                )
-                print("DEBUG: ✅ Face detection succeeded without enforcement")
-            except Exception as fallback_error:
-                print(f"DEBUG: ❌ All face detection methods failed: {fallback_error}")
-                return jsonify({'status': 'no_face_detected', 'message': 'No clear face detected. Please face the camera directly with good lighting.'}), 200
-
-        if not live_embedding_obj or 'embedding' not in live_embedding_obj[0]:
-            return jsonify({'status': 'no_face_detected', 'message': 'Could not create an embedding for the detected face.'}), 200
-
-        live_embedding = live_embedding_obj[0]['embedding']
-        
-        # 4.5. Enhanced quality check - if ALL distances are very high, suggest retry
-        quick_distances = []
-        # Sample more faces for better quality assessment, but limit to 5 for speed
-        sample_size = min(5, len(enrolled_embeddings_list))
-        for enrolled_face in enrolled_embeddings_list[:sample_size]:
-            enrolled_embedding = enrolled_face['embedding']
-            distance = find_cosine_distance(live_embedding, enrolled_embedding)
-            quick_distances.append(distance)
-        
-        avg_distance = sum(quick_distances) / len(quick_distances) if quick_distances else 1.0
-        print(f"DEBUG: Enhanced quality check - Average distance from {sample_size} samples: {avg_distance:.4f}")
-        
-        # More lenient quality check - only reject very poor quality images
-        if avg_distance > 0.90:
-            return jsonify({
-                'status': 'poor_quality', 
-                'message': f'Image quality too poor (avg: {avg_distance:.2f}). Please ensure good lighting and face camera directly.'
-            }), 200
-
-        # 5. Manually find the best match from our cached embeddings
-        best_match_uid = None
-        # The threshold for SFace - slightly more lenient for better recognition
-        # while still maintaining security. Updated to 0.68 for better matching.
-        # Updated: 2025-08-18 - Changed from 0.65 to 0.68 for better recognition accuracy
-        smallest_distance = 0.68
-        print("DEBUG: ===== FACE RECOGNITION v2.2 - 2025-08-18 OPTIMIZED =====")
-        print("DEBUG: Starting face comparison against cache...")
-        print(f"DEBUG: Using threshold: {smallest_distance:.4f}")
-        print(f"DEBUG: Total enrolled faces in cache: {len(enrolled_embeddings_list)}")
-        
-        # Store all comparisons for detailed logging
-        all_comparisons = []
-
-        for enrolled_face in enrolled_embeddings_list:
-            enrolled_embedding = enrolled_face['embedding']
-            distance = find_cosine_distance(live_embedding, enrolled_embedding)
-            
-            # Store comparison details
-            comparison_info = {
-                'uid': enrolled_face['uid'],
-                'distance': distance,
-                'is_best_so_far': distance < smallest_distance
-            }
-            all_comparisons.append(comparison_info)
-            
-            print(f"DEBUG: Comparing with UID {enrolled_face['uid']}. Distance: {distance:.4f}")
-
-            if distance < smallest_distance:
-                print(f"DEBUG: ⭐ NEW BEST MATCH! UID: {enrolled_face['uid']}, Distance: {distance:.4f} (Previous best: {smallest_distance:.4f})")
-                smallest_distance = distance
-                best_match_uid = enrolled_face['uid']
-        
-        # Enhanced debugging output
-        print("\n" + "="*60)
-        print("🔍 FACE RECOGNITION COMPARISON SUMMARY - v2.2 OPTIMIZED")
-        print("="*60)
-        print(f"📊 Total students compared: {len(all_comparisons)}")
-        print(f"🎯 Recognition threshold: {0.68:.4f}")
-        print(f"🏆 Best match distance: {smallest_distance:.4f}")
-        print(f"✅ Match found: {'YES' if best_match_uid else 'NO'}")
-        print(f"🕐 Timestamp: {datetime.now().isoformat()}")
-        print("🚀 OPTIMIZED VERSION - Improved Quality & Reduced API Calls")
-        
-        if best_match_uid:
-            print(f"👤 Best match UID: {best_match_uid}")
-        
-        # Show top 3 closest matches for debugging
-        all_comparisons.sort(key=lambda x: x['distance'])
-        print(f"\n🥇 TOP 3 CLOSEST MATCHES:")
-        for i, comp in enumerate(all_comparisons[:3]):
-            status = "✅ RECOGNIZED" if comp['distance'] < 0.68 else "❌ TOO FAR"
-            print(f"   {i+1}. UID: {comp['uid'][:8]}... | Distance: {comp['distance']:.4f} | {status}")
-        
-        print("="*60 + "\n")
-        
+        # 3. Process the incoming image
+        with timed_stage(timings, 'decode'):
+            image_data = image_bytes_from_request(request)
+            img_array = load_image_array(image_data, IMAGE_MAX_SIDE)
+            del image_data
+
+        # 4. Detect the face, letting the detector cascade pick backends
+        # within the per-request time budget, then embed it with SFace
+        def detect_with(backend, enforce_detection):
+            if group_mode:
+                return extract_faces(img_array, detector_backend=backend, enforce_detection=enforce_detection)
+            return extract_face(img_array, detector_backend=backend, enforce_detection=enforce_detection)
+
+        with timed_stage(timings, 'detection'):
+            faces, detector_backend, detection_attempts = detector_cascade.detect(detect_with)
+        for backend, succeeded, seconds in detection_attempts:
+            detection_seconds.observe(seconds, backend=backend, outcome='ok' if succeeded else 'failed')
+        details['detectorBackend'] = detector_backend
+        details['detectionAttempts'] = [
+            {'backend': backend, 'ok': succeeded, 'ms': round(seconds * 1000, 1)}
+            for backend, succeeded, seconds in detection_attempts
+        ]
+
+        if not faces and detector_backend is None:
+            return {'status': 'no_face_detected', 'message': 'No clear face detected. Please face the camera directly with good lighting.'}, 200
+
+        if not faces:
+            return {'status': 'no_face_detected', 'message': 'Could not create an embedding for the detected face.'}, 200
+
+        if group_mode:
+            return _recognize_group(faces, detector_backend, index, decoded_token, timings, details)
+
+        # Shares a forward pass with concurrent requests (see inference_scheduler.py)
+        with timed_stage(timings, 'embedding'):
+            live_embedding = inference_scheduler.embed(faces[:1])[0]
+        query = normalize_embeddings(live_embedding)
+
+        # A repeated frame of a face this kiosk just recognized gets the same answer
+        device_id = request.headers.get('X-Device-Id') or decoded_token.get('uid')
+        cache_generation = (enrolled_faces.last_refresh, attendance_ledger.day)
+        if recent_recognitions.enabled:
+            with timed_stage(timings, 'session'):
+                cached_response = recent_recognitions.lookup(device_id, query, cache_generation)
+            details['sessionCache'] = 'miss' if cached_response is None else 'hit'
+            if cached_response is not None:
+                return {**cached_response, 'detectorBackend': detector_backend}, 200
+
+        # 5. Find the closest enrolled students using the face index
+        with timed_stage(timings, 'matching'):
+
+            # 5.5. Enhanced quality check - if ALL distances are very high, suggest retry
+            # Sample more faces for better quality assessment, but limit to 5 for speed
+            sample_size = min(QUALITY_SAMPLE_SIZE, len(index))
+            avg_distance = float(index.sample_distances(query, sample_size).mean()) if sample_size else 1.0
+            details['qualityAvgDistance'] = round(avg_distance, 4)
+
+            # More lenient quality check - only reject very poor quality images
+            if avg_distance > QUALITY_MAX_AVG_DISTANCE:
+                return {
+                    'status': 'poor_quality',
+                    'message': f'Image quality too poor (avg: {avg_distance:.2f}). Please ensure good lighting and face camera directly.'
+                }, 200
+
+            top_matches, scanned = index.search(query, TOP_K_MATCHES)
+        if not top_matches:
+            return {'status': 'unknown', 'message': 'No confident match found.'}, 200
+
+        closest_uid, smallest_distance = top_matches[0]
+        best_match_uid = closest_uid if smallest_distance < RECOGNITION_THRESHOLD else None
+        details.update({
+            'bestDistance': round(smallest_distance, 4), 'scanned': scanned, 'indexSize': len(index),
+            'indexMode': index.mode, 'matchedUid': best_match_uid,
+        })
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Top %d matches (threshold %.4f): %s", len(top_matches), RECOGNITION_THRESHOLD,
+                         ', '.join(f"{uid[:8]}... {distance:.4f}" for uid, distance in top_matches))
+
         if not best_match_uid:
             # Show why no match was found
-            closest_distance = all_comparisons[0]['distance'] if all_comparisons else 'N/A'
-            closest_uid = all_comparisons[0]['uid'][:8] + '...' if all_comparisons else 'N/A'
-            return jsonify({
-                'status': 'unknown', 
-                'message': f'No confident match found. Closest: {closest_distance:.4f} (UID: {closest_uid}), Threshold: 0.68'
-            }), 200
-
-        # 6. Fetch student data from Firestore using the authUid
-        print(f"🔍 DEBUG: Found best match! Fetching student data for authUid: {best_match_uid}")
-        student_query = db.collection('students').where("authUid", "==", best_match_uid).limit(1)
-        student_snapshot = student_query.get()
-
-        if not student_snapshot:
-             print(f"❌ DEBUG: Firestore lookup FAILED. No document found for authUid: {best_match_uid}")
-             return jsonify({'status': 'unknown', 'message': f'Matching face found but no student record for authUid {best_match_uid}.'}), 200
-        
-        student_doc = student_snapshot[0]
-        student_data = student_doc.to_dict()
+            return {
+                'status': 'unknown',
+                'message': f'No confident match found. Closest: {smallest_distance:.4f} (UID: {closest_uid[:8]}...), Threshold: {RECOGNITION_THRESHOLD}'
+            }, 200
+
+        # 6. Look up the student's profile, kept alongside the face index
+        with timed_stage(timings, 'profile'):
+            student = lookup_student(best_match_uid)
+        if student is None:
+            return {'status': 'unknown', 'message': f'Matching face found but no student record for authUid {best_match_uid}.'}, 200
+
+        student_doc_id, student_data = student
         student_name = student_data.get('fullName', 'Unknown Student')
-        student_class = student_data.get('class', 'Unknown Class')
-        student_phone = student_data.get('phone', 'No Phone')
-        
-        print(f"✅ DEBUG: Firestore lookup SUCCEEDED!______@s")
-        print(f"   📋 Document ID: {student_doc.id}")
-        print(f"   👤 Student Name: {student_name}")
-        print(f"   📚 Class: {student_class}")
-        print(f"   📱 Phone: {student_phone}")
-        print(f"   🎯 Recognition Distance: {smallest_distance:.4f}")
-        print(f"   🆔 Auth UID: {best_match_uid}")
-        student_doc_id = student_doc.id # Get the actual document ID for the response
-
-        # --- New Attendance Logic with Firestore Read/Write ---
+        details['studentId'] = student_doc_id
+
+        # --- Attendance Logic (in-memory ledger, written behind to Firestore) ---
         attendance_status = "present" # Default
         try:
-            today_str = date.today().isoformat()
-            
-            # 1. Check if attendance for today already exists
-            attendance_ref = db.collection("attendance")
-            query = attendance_ref.where("authUid", "==", best_match_uid).where("date", "==", today_str).limit(1)
-            existing_attendance_docs = list(query.stream())
-
-            if existing_attendance_docs:
-                # Record exists, use its status and don't write a new one
-                existing_data = existing_attendance_docs[0].to_dict()
-                attendance_status = existing_data.get("status", "present")
-                print(f"DEBUG: Found existing attendance for {student_name}. Status: {attendance_status}")
-            else:
-                # No record exists, so calculate status and then create a new record
-                print(f"DEBUG: No existing attendance for {student_name}. Calculating and writing new record...")
-                
-                # 2. Load class configurations from Firestore
-                print(f"DEBUG: Loading class configurations from Firestore...")
-                classes_ref = db.collection("classes")
-                classes_snapshot = classes_ref.stream()
-                class_configs = {}
-                for class_doc in classes_snapshot:
-                    class_configs[class_doc.id] = class_doc.to_dict()
-                print(f"DEBUG: Loaded {len(class_configs)} class configurations")
-                
-                # 3. Determine student's class and shift
-                student_class_str = student_data.get("class")
-                student_shift_str = student_data.get("shift")
-                print(f"DEBUG: Student {student_name} - Class: {student_class_str}, Shift: {student_shift_str}")
-
-                if student_class_str and student_shift_str:
-                    student_class_key = student_class_str.replace("Class ", "")
-                    class_config = class_configs.get(student_class_key)
-                    print(f"DEBUG: Looking for class config with key: {student_class_key}")
-                    print(f"DEBUG: Available class keys: {list(class_configs.keys())}")
-                    print(f"DEBUG: Found class config: {class_config is not None}")
-                    
-                    shift_config = class_config.get("shifts", {}).get(student_shift_str) if class_config else None
-                    print(f"DEBUG: Found shift config: {shift_config is not None}")
-                    if shift_config:
-                        print(f"DEBUG: Shift config: {shift_config}")
-
-                    # 4. Calculate late status
-                    if shift_config and "startTime" in shift_config:
-                        start_hour, start_minute = map(int, shift_config["startTime"].split(':'))
-                        
-                        phnom_penh_tz = timezone(timedelta(hours=7))
-                        now_phnom_penh = datetime.now(phnom_penh_tz)
-                        
-                        shift_start_time = now_phnom_penh.replace(hour=start_hour, minute=start_minute, second=0, microsecond=0)
-
-                        # 5. Handle grace period (more robustly)
-                        grace_minutes = 15 # Default
-                        # Check for both 'gracePeriodMinutes' and a common typo 'gradePeriodMinutes'
-                        student_grace_period = student_data.get("gracePeriodMinutes") or student_data.get("gradePeriodMinutes")
-
-                        if student_grace_period is not None:
-                            try:
-                                # This handles both numbers (int, float) and strings like "30"
-                                grace_minutes = int(float(student_grace_period))
-                            except (ValueError, TypeError):
-                                print(f"WARN: Could not parse grace period '{student_grace_period}' for {student_name}. Using default.")
-
-                        on_time_deadline = shift_start_time + timedelta(minutes=grace_minutes)
-
-                        if now_phnom_penh > on_time_deadline:
-                            attendance_status = "late"
-                            
-                        print(f"DEBUG: Attendance calculation for {student_name}:")
-                        print(f"DEBUG: - Current time (Phnom Penh): {now_phnom_penh}")
-                        print(f"DEBUG: - Shift start time: {shift_start_time}")
-                        print(f"DEBUG: - Grace period: {grace_minutes} minutes")
-                        print(f"DEBUG: - On-time deadline: {on_time_deadline}")
-                        print(f"DEBUG: - Final status: {attendance_status}")
-                    else:
-                        print(f"DEBUG: Cannot calculate late status - missing shift start time")
-                        if not shift_config:
-                            print(f"DEBUG: No shift config found for shift '{student_shift_str}'")
-                        else:
-                            print(f"DEBUG: Shift config exists but missing startTime: {shift_config}")
-                else:
-                    print(f"DEBUG: Student {student_name} is missing class or shift information.")
-
-                # Write the new attendance record to Firestore
-                admin_email = decoded_token.get("email", "unknown_admin")
-                new_record = {
-                    "studentId": student_doc_id, "authUid": best_match_uid,
-                    "studentName": student_name, "class": student_data.get("class"),
-                    "shift": student_data.get("shift"), "status": attendance_status,
-                    "date": today_str, "timestamp": firestore.SERVER_TIMESTAMP,
-                    "scannedBy": f"Face Recognition by {admin_email}"
-                }
-                db.collection("attendance").add(new_record)
-                print(f"DEBUG: Successfully wrote new attendance record for {student_name} with status: {attendance_status}")
+            with timed_stage(timings, 'attendance'):
+                attendance_status, details['attendance'] = record_attendance(
+                    best_match_uid, student_doc_id, student_data, decoded_token)
+            details['attendanceStatus'] = attendance_status
 
-        except Exception as e:
-            print(f"ERROR: Could not calculate or write attendance status: {e}")
-            traceback.print_exc()
-        # --- End of New Attendance Logic ---
-
-        # This is where you would add your attendance marking logic.
-        # For now, we just return the recognized student's info.
-        
-        return jsonify({
+        except Exception:
+            logger.exception("Could not calculate or write attendance status")
+        # --- End of Attendance Logic ---
+
+        response = {
             'status': 'recognized',
             'message': f'Welcome, {student_name}!',
             'studentName': student_name,
             'studentUid': student_doc_id, # Return the document ID
-            'attendanceStatus': attendance_status
-        }), 200
-
+            'attendanceStatus': attendance_status,
+            'detectorBackend': detector_backend
+        }
+        if recent_recognitions.enabled:
+            recent_recognitions.store(device_id, query, response, cache_generation)
+        return response, 200
+
+    except ImageRequestError as e:
+        return {'error': str(e)}, 400
+    except SchedulerBusy as e:
+        logger.warning("Rejecting recognition request: %s", e)
+        return {'status': 'busy', 'error': 'The service is busy. Please try again in a moment.'}, 503
     except ValueError as ve:
         # This error is often thrown by DeepFace if no face is detected in the input image.
-        print(f"Face detection error: {ve}")
-        return jsonify({'status': 'no_face_detected', 'message': 'Could not detect a face in the provided image.'}), 200
-    except Exception as e:
-        print(f"An error occurred during recognition: {e}")
-        traceback.print_exc()
-        return jsonify({'error': 'An internal server error occurred.'}), 500
+        logger.info("Face detection error: %s", ve)
+        return {'status': 'no_face_detected', 'message': 'Could not detect a face in the provided image.'}, 200
+    except Exception:
+        logger.exception("An error occurred during recognition")
+        return {'error': 'An internal server error occurred.'}, 500
+
+
+def lookup_student(auth_uid):
+    """
+    Returns (student document id, profile data) for a matched authUid from
+    the profile map kept alongside the face index, or None if the student
+    has no document.
+    """
+    profile = enrolled_faces.profiles.get(auth_uid)
+    if profile is not None:
+        return profile.doc_id, profile.data
+
+    # Not in the profile cache (should not happen); ask Firestore
+    logger.warning("No cached profile for authUid %s, querying Firestore.", auth_uid)
+    student_snapshot = db.collection('students').where("authUid", "==", auth_uid).limit(1).get()
+    if not student_snapshot:
+        logger.warning("No student document found for authUid %s", auth_uid)
+        return None
+    return student_snapshot[0].id, student_snapshot[0].to_dict()
+
+
+def record_attendance(auth_uid, student_doc_id, student_data, decoded_token):
+    """
+    Returns today's attendance status of a recognized student, queueing a
+    new record in the ledger on the first scan of the day. The second value
+    tells whether the record was 'existing' or 'queued'.
+    """
+    # 1. Check if attendance for today already exists
+    existing_status = attendance_ledger.status(auth_uid)
+    if existing_status is not None:
+        # Record exists, use its status and don't write a new one
+        return existing_status, 'existing'
+
+    # 2. Late/present from the cached shift schedules (no Firestore reads)
+    attendance_status = class_schedules.attendance_status(student_data, datetime.now(PHNOM_PENH_TZ))
+
+    # Queue the new attendance record; the ledger commits it in a batch.
+    # The scan time is recorded here because the write happens later.
+    admin_email = decoded_token.get("email", "unknown_admin")
+    new_record = {
+        "studentId": student_doc_id, "authUid": auth_uid,
+        "studentName": student_data.get('fullName', 'Unknown Student'), "class": student_data.get("class"),
+        "shift": student_data.get("shift"), "status": attendance_status,
+        "date": attendance_ledger.day, "timestamp": datetime.now(timezone.utc),
+        "scannedBy": f"Face Recognition by {admin_email}"
+    }
+    return attendance_ledger.mark(auth_uid, new_record), 'queued'
+
+
+def _recognize_group(face_objs, detector_backend, index, decoded_token, timings, details):
+    """
+    Group check-in: embeds every face of the frame in one batch, matches
+    them against the roster with one search, and checks in each recognized
+    student once. Returns (response body, HTTP status).
+    """
+    # The unenforced fallback returns the whole frame (confidence 0) when it finds no face
+    face_objs = [face_obj for face_obj in face_objs if face_obj.get('confidence')]
+    if not face_objs:
+        return {'status': 'no_face_detected', 'message': 'No clear face detected. Please face the camera directly with good lighting.'}, 200
+    # The largest faces belong to the students closest to the kiosk
+    face_objs.sort(key=lambda face_obj: face_obj['facial_area']['w'] * face_obj['facial_area']['h'], reverse=True)
+    face_objs = face_objs[:GROUP_MAX_FACES]
+
+    with timed_stage(timings, 'embedding'):
+        embeddings = inference_scheduler.embed([face_obj['face'] for face_obj in face_objs])
+
+    with timed_stage(timings, 'matching'):
+        queries = normalize_embeddings(embeddings)
+        sample_size = min(QUALITY_SAMPLE_SIZE, len(index))
+        avg_distances = index.sample_distances(queries, sample_size).mean(axis=0) if sample_size else np.ones(len(queries))
+        searches = index.search_batch(queries, 1)
+
+    # Each student is checked in by their closest face; other faces matching
+    # the same student are reported as duplicates
+    best_face = {}
+    for position, (matches, _) in enumerate(searches):
+        if matches and matches[0][1] < RECOGNITION_THRESHOLD and avg_distances[position] <= QUALITY_MAX_AVG_DISTANCE:
+            auth_uid, distance = matches[0]
+            if auth_uid not in best_face or distance < searches[best_face[auth_uid]][0][0][1]:
+                best_face[auth_uid] = position
+    matched_positions = {position: auth_uid for auth_uid, position in best_face.items()}
+
+    results = []
+    recognized = 0
+    with timed_stage(timings, 'attendance'):
+        for position, (face_obj, (matches, _)) in enumerate(zip(face_objs, searches)):
+            area = face_obj['facial_area']
+            result = {'face': position, 'box': {key: int(area[key]) for key in ('x', 'y', 'w', 'h')}}
+            if matches:
+                result['distance'] = round(matches[0][1], 4)
+            results.append(result)
+
+            if avg_distances[position] > QUALITY_MAX_AVG_DISTANCE:
+                result['status'] = 'poor_quality'
+                continue
+            if position not in matched_positions:
+                is_duplicate = bool(matches) and matches[0][1] < RECOGNITION_THRESHOLD
+                result['status'] = 'duplicate' if is_duplicate else 'unknown'
+                continue
+
+            auth_uid = matched_positions[position]
+            student = lookup_student(auth_uid)
+            if student is None:
+                result['status'] = 'unknown'
+                continue
+
+            student_doc_id, student_data = student
+            result.update({
+                'status': 'recognized', 'studentName': student_data.get('fullName', 'Unknown Student'),
+                'studentUid': student_doc_id, 'attendanceStatus': 'present',
+            })
+            recognized += 1
+            try:
+                result['attendanceStatus'], _ = record_attendance(auth_uid, student_doc_id, student_data, decoded_token)
+            except Exception:
+                logger.exception("Could not calculate or write attendance status for %s", student_doc_id)
+
+    details.update({'faces': len(results), 'recognizedFaces': recognized, 'scanned': searches[0][1], 'indexSize': len(index)})
+    return {
+        'status': 'recognized' if recognized else 'unknown',
+        'message': f'Recognized {recognized} of {len(results)} faces.',
+        'faces': results,
+        'recognizedCount': recognized,
+        'detectorBackend': detector_backend,
+    }, 200
 
 
 @app.route('/generate-embedding', methods=['POST'])
 @cross_origin()
 def generate_embedding():
     """
-    Receives an image (as base64 string), calculates its FaceNet embedding,
-    and returns it. This is used by the enrollment Cloud Function.
+    Receives an image (as base64 string, raw body or multipart upload),
+    calculates its FaceNet embedding, and returns it. This is used by the
+    enrollment Cloud Function.
     """
     # Security: In a production environment, you would want to secure this
     # endpoint, for example, by checking for a secret header or an
     # service-to-service authentication token.
-    data = request.get_json()
-    if 'image' not in data:
-        return jsonify({'error': 'Missing image data in request.'}), 400
-
     try:
-        image_data = base64.b64decode(data['image'])
-        img_array = np.array(Image.open(io.BytesIO(image_data)))
+        image_data = image_bytes_from_request(request)
+        img_array = load_image_array(image_data, IMAGE_MAX_SIDE)
+    except ImageRequestError as e:
+        return jsonify({'error': str(e)}), 400
 
+    try:
         # Use enforce_detection=False because we trust the enrollment photos
-        # are cropped and contain a face.
-        embedding_obj = DeepFace.represent(
-            img_path=img_array,
-            model_name='SFace',
-            enforce_detection=False
-        )
-        
-        if not embedding_obj or 'embedding' not in embedding_obj[0]:
+        # are cropped and contain a face. Detection and SFace run through the
+        # same locked detector and embedder as /recognize, whose inference
+        # thread may be using the model at the same time.
+        faces = extract_face(img_array, detector_backend='opencv', enforce_detection=False)
+        if not faces:
             return jsonify({'error': 'Could not generate embedding.'}), 500
 
         # Return just the vector
-        return jsonify({'embedding': embedding_obj[0]['embedding']}), 200
+        return jsonify({'embedding': sface_embedder.embed(faces[:1])[0]}), 200
 
-    except Exception as e:
-        print(f"An error occurred during embedding generation: {e}")
-        traceback.print_exc()
+    except Exception:
+        logger.exception("An error occurred during embedding generation")
+        return jsonify({'error': 'An internal server error occurred during embedding generation.'}), 500
+
+
+@app.route('/generate-embeddings', methods=['POST'])
+@cross_origin()
+def generate_embeddings_batch():
+    """
+    Batch version of /generate-embedding for bulk enrollment. Accepts either
+    JSON {"images": [base64, ...]} or a multipart upload with one or more
+    'images' files. Images are decoded in parallel and their faces detected,
+    then all faces go through SFace in batched forward passes.
+
+    Returns {"results": [...]} in request order, where every entry is either
+    {"embedding": [...]} or {"error": "..."}.
+    """
+    if request.files:
+        images = [upload.read() for upload in request.files.getlist('images')]
+    else:
+        data = request.get_json(silent=True) or {}
+        images = data.get('images')
+        if not isinstance(images, list):
+            return jsonify({'error': "Missing 'images' list in request."}), 400
+
+    if not images:
+        return jsonify({'error': 'No images in request.'}), 400
+    if len(images) > EMBEDDING_BATCH_MAX_IMAGES:
+        return jsonify({'error': f'Too many images in one request (max {EMBEDDING_BATCH_MAX_IMAGES}).'}), 413
+
+    def decode_and_detect(image):
+        image_data = decode_base64_image(image) if isinstance(image, str) else image
+        img_array = load_image_array(image_data, IMAGE_MAX_SIDE)
+        # Use enforce_detection=False because we trust the enrollment photos
+        # are cropped and contain a face.
+        faces = extract_face(img_array, detector_backend='opencv', enforce_detection=False)
+        if not faces:
+            raise ValueError('No face found in image.')
+        return faces[0]
+
+    try:
+        started = time.perf_counter()
+        futures = [embedding_batch_pool.submit(decode_and_detect, image) for image in images]
+        results = [None] * len(images)
+        faces = []
+        face_positions = []
+        for position, future in enumerate(futures):
+            try:
+                faces.append(future.result())
+                face_positions.append(position)
+            except Exception as e:
+                logger.debug("Batch image %d failed during decode/detection: %s", position, e)
+                results[position] = {'error': f'Could not process image: {e}'}
+
+        detected = time.perf_counter()
+        for position, embedding in zip(face_positions, sface_embedder.embed(faces)):
+            results[position] = {'embedding': embedding}
+
+        failed = sum(1 for result in results if 'error' in result)
+        logger.info("Batch embedding: %d images, %d failed, decode/detect %.2fs, embed %.2fs",
+                    len(images), failed, detected - started, time.perf_counter() - detected)
+        return jsonify({'results': results, 'count': len(results), 'failed': failed}), 200
+
+    except Exception:
+        logger.exception("An error occurred during batch embedding generation")
         return jsonify({'error': 'An internal server error occurred during embedding generation.'}), 500
 
 
@@ -475,6 +764,45 @@ def health_check():
     """A simple health check endpoint."""
     return "OK", 200
 
+
+@app.route('/ready', methods=['GET'])
+@cross_origin()
+def readiness_check():
+    """
+    Readiness probe, separate from /health: 200 only once the models are
+    warm and the enrolled faces index is loaded, 503 before that.
+    """
+    index = enrolled_faces.index
+    body = {
+        'ready': is_ready(),
+        'warmup': {'mode': WARMUP_MODE, **warmup_status},
+        'enrolledFaces': {
+            'loaded': index is not None, 'embeddings': len(index) if index is not None else 0,
+            'storage': FACE_INDEX_STORAGE, 'bytes': index.rows.nbytes if index is not None else 0,
+            'sharedRole': enrolled_faces.role,
+        },
+        'tokenCache': token_cache.stats(),
+        'sessionCache': recent_recognitions.stats(),
+        'inference': inference_scheduler.stats(),
+        'attendanceLedger': {
+            'day': attendance_ledger.day, 'pendingWrites': attendance_ledger.pending,
+            'written': attendance_ledger.written, 'failed': attendance_ledger.failed,
+        },
+    }
+    return jsonify(body), 200 if body['ready'] else 503
+
+
+@app.route('/detector-stats', methods=['GET'])
+@cross_origin()
+def detector_stats():
+    """Per-backend success rate and latency as seen by the detector cascade."""
+    return jsonify(detector_cascade.stats_snapshot()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint: stage latencies, cache sizes and refresh durations."""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     # This is used for local development.
     # Gunicorn will be used in production on Cloud Run.
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class RecentRecognitionCache:
+    """
+    Short-lived per-device memory of the faces a kiosk recognized last.
+
+    While a student stands in front of the camera the kiosk keeps sending
+    frames of the same face. Every recognized frame is stored with its
+    normalized live embedding and response; a later frame from the same
+    device whose embedding lies within `max_distance` (cosine) of a stored
+    one, less than `ttl` seconds after it, gets that response back without
+    a roster scan, profile lookup or attendance check.
+
+    Entries also carry a `generation` (e.g. the index swap time and the
+    attendance day); a lookup with a different generation never hits, so a
+    roster change or a new day is never answered from the cache. At most
+    `max_devices` devices (LRU) with `entries_per_device` faces each are
+    kept.
+    """
+
+    def __init__(self, ttl=10.0, max_distance=0.2, entries_per_device=4, max_devices=1024):
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.entries_per_device = entries_per_device
+        self.max_devices = max_devices
+        self.hits = 0
+        self.misses = 0
+        self._devices = OrderedDict()  # device id -> [(embedding, response, generation, stored at)]
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def lookup(self, device_id, embedding, generation):
+        """
+        Returns the cached response for a normalized embedding close to one
+        the device recognized recently, or None.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entries = self._devices.get(device_id)
+            if entries:
+                entries[:] = [entry for entry in entries if now - entry[3] < self.ttl and entry[2] == generation]
+            if not entries:
+                self._devices.pop(device_id, None)
+                self.misses += 1
+                return None
+            distances = 1.0 - np.stack([entry[0] for entry in entries]) @ embedding
+            closest = int(np.argmin(distances))
+            if distances[closest] > self.max_distance:
+                self.misses += 1
+                return None
+            self._devices.move_to_end(device_id)
+            self.hits += 1
+            return entries[closest][1]
+
+    def store(self, device_id, embedding, response, generation):
+        """Remembers the response the device got for a normalized embedding."""
+        with self._lock:
+            entries = self._devices.setdefault(device_id, [])
+            entries.append((embedding, response, generation, time.monotonic()))
+            del entries[:-self.entries_per_device]
+            self._devices.move_to_end(device_id)
+            while len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            devices = len(self._devices)
+            entries = sum(len(device_entries) for device_entries in self._devices.values())
+        lookups = self.hits + self.misses
+        return {
+            'devices': devices, 'entries': entries, 'ttlSeconds': self.ttl, 'maxDistance': self.max_distance,
+            'hits': self.hits, 'misses': self.misses,
+            'hitRate': round(self.hits / lookups, 4) if lookups else None,
+        }
@@ -0,0 +1,72 @@
+"""
+Face index shared between the gunicorn workers of one instance.
+
+One worker, the leader, holds an exclusive flock on `leader.lock` in the
+shared directory. It alone talks to Firestore, and after every index swap
+it publishes the search-ready index there as a new version, in the same
+format and through the same `CURRENT` pointer as the embeddings snapshot
+(see embeddings_snapshot.py). Every worker, the leader included,
+memory-maps the current version, so on a tmpfs such as /dev/shm the roster
+is held once per instance whatever the worker count. When the leader
+exits, the kernel drops its lock and the next worker to poll takes over.
+"""
+import fcntl
+import os
+
+from embeddings_snapshot import current_snapshot_path, load_snapshot, write_snapshot
+
+LEADER_LOCK_FILE = 'leader.lock'
+# Older versions are removed as soon as a new one is current. A worker still
+# mapping one keeps its memory alive until it maps the new version, but the
+# shared directory itself never holds a second copy of the roster.
+PREVIOUS_VERSIONS_TO_KEEP = 0
+
+
+class LeaderLock:
+    """Non-blocking exclusive flock, held until the process exits."""
+
+    def __init__(self, root):
+        self.path = os.path.join(root, LEADER_LOCK_FILE)
+        self._file = None
+
+    @property
+    def held(self):
+        return self._file is not None
+
+    def acquire(self):
+        """Returns True if this process holds (or just took) the lock."""
+        if self._file is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+
+def publish_index(root, index, students, high_water_mark=None):
+    """
+    Writes the index and its (doc_id, authUid, profile, update time)
+    students as a new version and makes it current. Returns the path of the
+    new version.
+    """
+    return write_snapshot(root, index, students, high_water_mark=high_water_mark,
+                          previous_versions=PREVIOUS_VERSIONS_TO_KEEP)
+
+
+def current_version(root):
+    """Name of the current published version, or None."""
+    path = current_snapshot_path(root)
+    return os.path.basename(path) if path else None
+
+
+def load_published_index(root):
+    """
+    Memory-maps the current published version as an EmbeddingsSnapshot.
+    Returns None if nothing was published yet.
+    """
+    return load_snapshot(root)
@@ -0,0 +1,83 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from firebase_admin import auth
+
+
+class VerifiedTokenCache:
+    """
+    Bounded LRU cache of decoded Firebase ID tokens.
+
+    A kiosk sends the same admin token with every scan, so the signature is
+    verified once and the decoded token is reused until the token's `exp`.
+    Entries are keyed by a SHA-256 of the token so raw tokens are not kept
+    in memory. Failed verifications are never cached.
+
+    With `check_revoked`, tokens are verified with revocation checking (one
+    extra Auth lookup); `revocation_recheck_interval` then bounds how long a
+    cached token is trusted before that check is repeated, so a revoked
+    session is rejected within that many seconds.
+    """
+
+    def __init__(self, max_entries=256, check_revoked=False, revocation_recheck_interval=300):
+        self.max_entries = max_entries
+        self.check_revoked = check_revoked
+        self.revocation_recheck_interval = revocation_recheck_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # token hash -> (decoded token, verified at)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(id_token):
+        return hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+
+    def _lookup(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            decoded_token, verified_at = entry
+            expired = now >= decoded_token.get('exp', 0)
+            stale = self.check_revoked and now - verified_at >= self.revocation_recheck_interval
+            if expired or stale:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return decoded_token
+
+    def _store(self, key, decoded_token, now):
+        with self._lock:
+            self._entries[key] = (decoded_token, now)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def verify(self, id_token):
+        """
+        Returns the decoded token, verifying it only on a cache miss. Raises
+        whatever auth.verify_id_token raises for an invalid token.
+        """
+        key = self._key(id_token)
+        decoded_token = self._lookup(key, time.time())
+        if decoded_token is not None:
+            self.hits += 1
+            return decoded_token
+
+        self.misses += 1
+        decoded_token = auth.verify_id_token(id_token, check_revoked=self.check_revoked)
+        self._store(key, decoded_token, time.time())
+        return decoded_token
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        return {
+            'size': size, 'maxEntries': self.max_entries,
+            'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            'checkRevoked': self.check_revoked,
+        }
@@ -50,7 +50,7 @@ const db = getFirestore();
 
 // --- NEW: Define the URL for your Python face recognition service ---
 // This should be an authenticated endpoint in a real-world scenario.
-const FACE_RECOGNITION_SERVICE_URL = "https://face-recognition-service-us-central1-50079853705.us-central1.run.app/generate-embedding";
+const FACE_RECOGNITION_BATCH_URL = "https://face-recognition-service-us-central1-50079853705.us-central1.run.app/generate-embeddings";
 
 // --- The embedding logic is now handled by the Python service ---
 // function createNormalizedEmbedding(face) { ... } // This function is no longer needed.
@@ -3953,18 +3953,17 @@ exports.handleEnrollmentQueue = onDocumentCreated({
 
         console.log(`Processing task ${docId} for student UID: ${studentAuthUid}`);
         
-        const embeddingPromises = images.map(async (imageBase64) => {
-            const response = await axios.post(FACE_RECOGNITION_SERVICE_URL, { image: imageBase64 }, {
-                headers: { 'Content-Type': 'application/json' }
-            });
-            const { embedding } = response.data;
-            if (!embedding || !Array.isArray(embedding) || embedding.length === 0) {
-                throw new Error("The face recognition service returned an invalid embedding.");
+        // One batched request embeds all photos of the student in a single round-trip
+        const response = await axios.post(FACE_RECOGNITION_BATCH_URL, { images }, {
+            headers: { 'Content-Type': 'application/json' }
+        });
+        const allEmbeddings = (response.data.results || []).map((result, index) => {
+            const { embedding, error } = result;
+            if (error || !embedding || !Array.isArray(embedding) || embedding.length === 0) {
+                throw new Error(`The face recognition service returned an invalid embedding for photo ${index + 1}: ${error || "empty embedding"}`);
             }
             return embedding; // Return the raw embedding array
         });
-
-        const allEmbeddings = await Promise.all(embeddingPromises);
         
         if (allEmbeddings.length === 0) {
             throw new Error("No embeddings were generated from the provided images.");
@@ -3995,8 +3994,11 @@ exports.handleEnrollmentQueue = onDocumentCreated({
         const studentDocRef = studentSnapshot.docs[0].ref;
 
         // Store the single, averaged embedding (wrapped in an object for consistency)
+        // facialEmbeddingsUpdatedAt lets the face recognition service catch up
+        // on changed embeddings without re-reading every student
         await studentDocRef.update({ 
-            facialEmbeddings: [{ embedding: masterEmbedding }] 
+            facialEmbeddings: [{ embedding: masterEmbedding }],
+            facialEmbeddingsUpdatedAt: FieldValue.serverTimestamp()
         });
 
         console.log(`Successfully processed task ${docId} and stored a single averaged embedding from ${allEmbeddings.length} photos for student ${studentAuthUid}.`);